@@ -0,0 +1,163 @@
+"""
+Soft cosine based clustering and deduplication of documents.
+
+Documents are rows of a document by concept matrix in the order of the
+concept similarity matrix (see `SoftCosineCombinedSimilarity.
+transform_cpts_many`). Pairs are only scored if they can have a nonzero
+soft cosine: the product of the projected documents (`docs @ sim_dict`)
+and `docs.T` only touches the pairs with similar concepts, e.g. no pairs
+below different top concepts of the Lin similarity. The documents are
+projected once, then the row blocks are scored on a thread pool.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+from scipy.sparse import csr_matrix
+
+from thesaurus.compare_docs import project
+
+
+logger = logging.getLogger(__name__)
+
+
+def _norms(proj, docs):
+    return np.sqrt(np.asarray(proj.multiply(docs).sum(axis=1)).ravel())
+
+
+def _cosines(numerator, norms1, norms2):
+    denominator = norms1 * norms2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator != 0, numerator / denominator, 0.)
+
+
+def similar_pairs(docs, features_similarity, threshold, block_size=1000,
+                  n_threads=4):
+    """
+    All pairs of documents with a soft cosine of at least `threshold`.
+
+    :param docs: scipy.sparse matrix, one document per row
+    :param features_similarity: concept similarity matrix
+    :param threshold: minimal soft cosine, should be > 0
+    :param block_size: number of documents per task
+    :param n_threads: size of the thread pool
+    :return: (rows, cols, scores) arrays of the pairs with rows < cols
+    """
+    docs = csr_matrix(docs)
+    proj = csr_matrix(project(docs, features_similarity))
+    norms = _norms(proj, docs)
+
+    def block_pairs(start):
+        stop = min(start + block_size, docs.shape[0])
+        # The documents before the block were paired with it already
+        pairs = (proj[start:stop] @ docs[start:].T).tocoo()
+        rows, cols = pairs.row + start, pairs.col + start
+        keep = cols > rows
+        rows, cols = rows[keep], cols[keep]
+        scores = _cosines(pairs.data[keep], norms[rows], norms[cols])
+        keep = scores >= threshold
+        return rows[keep], cols[keep], scores[keep]
+
+    with ThreadPoolExecutor(n_threads) as executor:
+        blocks = list(executor.map(block_pairs,
+                                   range(0, docs.shape[0], block_size)))
+    rows, cols, scores = (np.concatenate([b[k] for b in blocks] +
+                                         [np.zeros(0, dtype)])
+                          for k, dtype in enumerate([np.int64, np.int64,
+                                                     np.float64]))
+    logger.info('{} pairs with a soft cosine of at least {}'.format(
+        len(scores), threshold))
+    return rows, cols, scores
+
+
+def threshold_clusters(docs, features_similarity, threshold, **kwargs):
+    """
+    Single linkage agglomerative clustering cut at `threshold`: documents
+    end up in the same cluster if they are connected by a chain of pairs
+    with a soft cosine of at least `threshold`. With a high threshold the
+    clusters are groups of near-duplicates.
+
+    :param kwargs: see `similar_pairs`
+    :return: np.ndarray of the cluster labels of the documents
+    """
+    n = docs.shape[0]
+    rows, cols, _ = similar_pairs(docs, features_similarity, threshold,
+                                  **kwargs)
+    graph = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                       shape=(n, n))
+    _, labels = scipy.sparse.csgraph.connected_components(graph,
+                                                          directed=False)
+    return labels
+
+
+def k_medoids(docs, features_similarity, k, max_iter=50, random_state=None,
+              block_size=1000, n_threads=4):
+    """
+    Alternating k-medoids with soft cosine similarity and k-medoids++
+    initialization. Every iteration scores the documents against the
+    medoids and, per cluster, all pairs of its members.
+
+    :param docs: scipy.sparse matrix, one document per row
+    :param features_similarity: concept similarity matrix
+    :param k: number of clusters
+    :param random_state: seed or np.random.RandomState
+    :param block_size: number of cluster members scored at once against the
+        whole cluster; bounds the memory to block_size * cluster size
+    :return: (medoids, labels): document ids of the medoids and the cluster
+        of every document
+    """
+    docs = csr_matrix(docs)
+    n = docs.shape[0]
+    k = min(k, n)
+    rng = random_state if isinstance(random_state, np.random.RandomState) \
+        else np.random.RandomState(random_state)
+    proj = csr_matrix(project(docs, features_similarity))
+    norms = _norms(proj, docs)
+
+    def similarities(rows, cols):
+        numerator = (proj[rows] @ docs[cols].T).toarray()
+        return _cosines(numerator, norms[rows][:, None], norms[cols][None, :])
+
+    medoids = [rng.randint(n)]
+    best = similarities(np.arange(n), medoids).ravel()
+    for _ in range(1, k):
+        weights = np.clip(1 - best, 0, None) ** 2
+        weights[medoids] = 0
+        if weights.sum() == 0:
+            candidates = np.setdiff1d(np.arange(n), medoids)
+            new = candidates[rng.randint(len(candidates))]
+        else:
+            new = rng.choice(n, p=weights / weights.sum())
+        medoids.append(new)
+        best = np.maximum(best, similarities(np.arange(n), [new]).ravel())
+    medoids = np.array(medoids)
+
+    def best_medoid(members):
+        member_docs = docs[members].T
+        sums = np.empty(len(members))
+        for start in range(0, len(members), block_size):
+            block = members[start:start + block_size]
+            numerator = (proj[block] @ member_docs).toarray()
+            sums[start:start + len(block)] = _cosines(
+                numerator, norms[block][:, None], norms[members][None, :]
+            ).sum(axis=1)
+        return members[np.argmax(sums)]
+
+    labels = None
+    with ThreadPoolExecutor(n_threads) as executor:
+        for it in range(max_iter):
+            labels = np.argmax(similarities(np.arange(n), medoids), axis=1)
+            labels[medoids] = np.arange(k)
+            new_medoids = np.array(list(executor.map(
+                best_medoid,
+                [np.flatnonzero(labels == c) for c in range(k)]
+            )))
+            if (new_medoids == medoids).all():
+                break
+            medoids = new_medoids
+        logger.info('k-medoids stopped after {} iterations'.format(it + 1))
+    labels = np.argmax(similarities(np.arange(n), medoids), axis=1)
+    labels[medoids] = np.arange(k)
+    return medoids, labels
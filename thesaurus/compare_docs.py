@@ -1,18 +1,17 @@
 """
 Functions for comparison
 """
+import os
 import numpy as np
 import scipy
-from scipy.linalg import norm
 from scipy.sparse import coo_matrix, csr_matrix
-import pickle
 import logging
-import json
 from time import time
 from collections import defaultdict, Counter
 from functools import lru_cache
 
-from thesaurus.thesaurus import Thesaurus, get_sim_dict
+from thesaurus.sim_dict import load_sim_dict, LazySimDict, QuantizedSimDict
+from thesaurus.compiled import UriIndex, CompiledThesaurus
 
 
 root_logger = logging.getLogger('root')
@@ -66,15 +65,209 @@ def soft_cosine(d1, d2, features_similarity):
         return 0
 
 
+def project(docs, features_similarity):
+    """
+    :param docs: scipy.sparse matrix, one document per row
+    :param features_similarity: scipy.sparse matrix, or a matrix like
+        thesaurus.sim_dict.LazySimDict that implements `rdot`
+    :return: docs times features_similarity
+    """
+    if hasattr(features_similarity, 'rdot'):
+        return features_similarity.rdot(docs)
+    return docs @ features_similarity
+
+
+def soft_cosine_matrix(docs1, docs2=None, features_similarity=None):
+    """
+    Soft cosine of all pairs of documents at once.
+
+    :param docs1: scipy.sparse.csr_matrix, one document per row
+    :param docs2: scipy.sparse.csr_matrix, `docs1` if None
+    :param features_similarity: A matrix whose i,j entry returns similarity
+            between features i and j; plain cosine if None
+    :return: np.ndarray of shape (docs1.shape[0], docs2.shape[0])
+    """
+    docs1 = csr_matrix(docs1)
+    docs2 = docs1 if docs2 is None else csr_matrix(docs2)
+    if features_similarity is None:
+        proj1 = docs1
+        proj2 = docs2
+    else:
+        proj1 = csr_matrix(project(docs1, features_similarity))
+        proj2 = proj1 if docs2 is docs1 else \
+            csr_matrix(project(docs2, features_similarity))
+    numerator = (proj1 @ docs2.T).toarray()
+    norms1 = np.sqrt(np.asarray(proj1.multiply(docs1).sum(axis=1)).ravel())
+    norms2 = np.sqrt(np.asarray(proj2.multiply(docs2).sum(axis=1)).ravel())
+    denominator = np.outer(norms1, norms2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator != 0, numerator / denominator, 0.)
+
+
+def weighted_jaccard_matrix(docs1, docs2=None, block_size=10):
+    """
+    Weighted Jaccard similarity (sum of the minimal over sum of the maximal
+    counts) of all pairs of term count vectors, the same as
+    `sum((t1 & t2).values()) / sum((t1 | t2).values())` for Counters.
+
+    :param docs1: scipy.sparse matrix of nonnegative counts, e.g. from
+        `TermVocabulary.transform_many`
+    :param docs2: same, `docs1` if None
+    :param block_size: number of rows of `docs1` compared at once; the
+        memory is bounded by the entries of `docs2` that share a term with
+        a block
+    :return: np.ndarray of shape (docs1.shape[0], docs2.shape[0])
+    """
+    docs1 = csr_matrix(docs1)
+    docs2 = docs1 if docs2 is None else csr_matrix(docs2)
+    n_terms = max(docs1.shape[1], docs2.shape[1])
+    docs1 = _with_columns(docs1, n_terms)
+    docs1.sum_duplicates()
+    docs2 = _with_columns(docs2, n_terms).tocsc()
+    docs2.sum_duplicates()
+    n1, n2 = docs1.shape[0], docs2.shape[0]
+    sizes1 = np.asarray(docs1.sum(axis=1)).ravel()
+    sizes2 = np.asarray(docs2.sum(axis=1)).ravel()
+    sims = np.empty((n1, n2))
+    for start in range(0, n1, block_size):
+        block = docs1[start:start + block_size].tocoo()
+        # All (entry of the block, entry of docs2) pairs with the same term
+        starts = docs2.indptr[block.col]
+        lens = docs2.indptr[block.col + 1] - starts
+        row_starts = np.cumsum(lens) - lens
+        pos = np.arange(lens.sum()) + np.repeat(starts - row_starts, lens)
+        rows1 = np.repeat(block.row, lens)
+        mins = np.minimum(np.repeat(block.data, lens), docs2.data[pos])
+        numerator = np.bincount(
+            rows1.astype(np.int64) * n2 + docs2.indices[pos],
+            weights=mins, minlength=block.shape[0] * n2
+        ).reshape(block.shape[0], n2)
+        denominator = (sizes1[start:start + block.shape[0], None] +
+                       sizes2[None, :] - numerator)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sims[start:start + block.shape[0]] = np.where(
+                denominator != 0, numerator / denominator, 0.
+            )
+    return sims
+
+
+def _with_columns(matrix, n_columns):
+    # Vectors of a growing vocabulary are padded to the current size
+    if matrix.shape[1] == n_columns:
+        return matrix
+    return csr_matrix((matrix.data, matrix.indices, matrix.indptr),
+                      shape=(matrix.shape[0], n_columns))
+
+
+class TermVocabulary:
+    """
+    Integer ids of the terms of documents. Term multi-sets become rows of
+    sparse count matrices with one column per term seen so far; vectors
+    transformed before the vocabulary grew are padded when compared.
+    """
+
+    def __init__(self, terms=()):
+        self.term_ids = dict()
+        for term in terms:
+            self.term_ids.setdefault(term, len(self.term_ids))
+
+    def __len__(self):
+        return len(self.term_ids)
+
+    def transform(self, term_dict):
+        """
+        :param term_dict: {term: term_freq} or collections.Counter
+        :return: scipy.sparse.csr_matrix with one row
+        """
+        return self.transform_many([term_dict])
+
+    def transform_many(self, term_dicts):
+        """
+        :param term_dicts: iterable of {term: term_freq}
+        :return: scipy.sparse.csr_matrix, one document per row. As with
+            Counter `&` and `|`, counts below 0 count as 0.
+        """
+        term_ids = self.term_ids
+        indptr = [0]
+        indices = []
+        data = []
+        for term_dict in term_dicts:
+            for term, freq in term_dict.items():
+                if freq > 0:
+                    indices.append(term_ids.setdefault(term, len(term_ids)))
+                    data.append(freq)
+            indptr.append(len(indices))
+        docs = csr_matrix(
+            (np.asarray(data, dtype=np.float64),
+             np.asarray(indices, dtype=np.int64), indptr),
+            shape=(len(indptr) - 1, len(term_ids))
+        )
+        docs.sum_duplicates()
+        return docs
+
+
+def quantization_report(sim_dict, quantized, docs=None, batch_size=1000):
+    """
+    Accuracy of a reduced precision similarity matrix.
+
+    :param sim_dict: the original matrix
+    :param quantized: thesaurus.sim_dict.QuantizedSimDict of `sim_dict`
+    :param docs: optional sample of documents (rows of a scipy.sparse matrix)
+        to compare the soft cosines on
+    :return: dict with the maximal and mean absolute error of the matrix
+        entries, the memory of both matrices in bytes and, if `docs` are
+        given, the maximal absolute error of their pairwise soft cosines
+    """
+    sim_dict = csr_matrix(sim_dict)
+    max_err = 0.
+    sum_err = 0.
+    for start in range(0, sim_dict.shape[0], batch_size):
+        inds = np.arange(start, min(start + batch_size, sim_dict.shape[0]))
+        err = abs(sim_dict[inds] - quantized.rows(inds))
+        if err.nnz:
+            max_err = max(max_err, err.max())
+            sum_err += err.sum()
+    report = {
+        'max_abs_error': float(max_err),
+        'mean_abs_error': float(sum_err / max(sim_dict.nnz, 1)),
+        'nbytes': sim_dict.data.nbytes + sim_dict.indices.nbytes +
+                  sim_dict.indptr.nbytes,
+        'quantized_nbytes': quantized.nbytes,
+    }
+    if docs is not None:
+        report['max_soft_cosine_error'] = float(np.abs(
+            soft_cosine_matrix(docs, None, sim_dict) -
+            soft_cosine_matrix(docs, None, quantized)
+        ).max(initial=0))
+    return report
+
+
 class SoftCosineCombinedSimilarity:
     def __init__(self,
                  sim_dict_path=None,
                  the=None,
+                 sim_dict=None,
+                 all_cpts=None,
+                 shared=False,
+                 lazy=False,
+                 max_rows=10000,
+                 sim_dtype=None,
                  **kwargs):
 
         """
         :param sim_dict_path:
         :param the: Thesaurus
+        :param sim_dict: similarity matrix to use instead of loading it from
+            `sim_dict_path`, together with `all_cpts`
+        :param all_cpts: list of concept URIs in the order of `sim_dict`
+        :param shared: keep the matrix and the concept index in shared
+            memory, so that forked worker processes do not copy them
+        :param lazy: compute the rows of the matrix from `the` (a Thesaurus
+            or a CompiledThesaurus) when they are needed and keep at most
+            `max_rows` of them, see thesaurus.sim_dict.LazySimDict
+        :param sim_dtype: store the matrix with reduced precision, one of
+            'float32', 'float16', 'uint16', 'uint8', see
+            thesaurus.sim_dict.QuantizedSimDict
         """
 
         def make_i2i(from_, to_):
@@ -85,18 +278,109 @@ class SoftCosineCombinedSimilarity:
             i2i = {k2i1[k]: k2i2[k] for k in k2i1}
             return i2i
 
-        self.sim_dict, self.all_cpts = get_sim_dict(
-            sim_dict_path=sim_dict_path, the=the
-        )
-        if not isinstance(self.sim_dict, scipy.sparse.csr_matrix):
+        if sim_dict is None and lazy:
+            compiled = the if isinstance(the, CompiledThesaurus) \
+                else the.compile()
+            sim_dict = LazySimDict(compiled, max_rows=max_rows)
+            all_cpts = sim_dict.all_cpts
+        elif sim_dict is None and the is None and sim_dict_path is not None \
+                and os.path.exists(sim_dict_path):
+            sim_dict, all_cpts = load_sim_dict(sim_dict_path)
+        elif sim_dict is None:
+            # Computing the matrix needs rdflib
+            from thesaurus.thesaurus import get_sim_dict
+            sim_dict, all_cpts = get_sim_dict(
+                sim_dict_path=sim_dict_path, the=the
+            )
+        self.sim_dict = sim_dict
+        if isinstance(self.sim_dict, np.ndarray) or \
+                scipy.sparse.issparse(self.sim_dict):
             self.sim_dict = scipy.sparse.csr_matrix(self.sim_dict)
-        self.all_cpts = [str(x) for x in self.all_cpts]
-        self.cpt_inds = {cpt: i for i, cpt in enumerate(self.all_cpts)}
+        if sim_dtype is not None:
+            self.sim_dict = QuantizedSimDict(self.sim_dict, dtype=sim_dtype)
+        self.all_cpts = [str(x) for x in all_cpts]
+        self.cpt_inds = UriIndex(self.all_cpts)
+        self.shared = None
+        self._init_caches()
+        if shared:
+            self._attach(self.share())
+
+    def share(self):
+        """
+        Copy the similarity matrix and the concept index to shared memory.
+
+        :return: thesaurus.shared.SharedArrays, pass its `handle` to
+            `from_shared` in other processes
+        """
+        from thesaurus.shared import SharedArrays
+        if isinstance(self.sim_dict, LazySimDict):
+            raise ValueError(
+                'A lazily computed similarity matrix cannot be shared, share '
+                'its compiled thesaurus (CompiledThesaurus.share) and create '
+                'a LazySimDict from it in every worker instead'
+            )
+        if isinstance(self.sim_dict, QuantizedSimDict):
+            arrays = {'quantized/' + k: v
+                      for k, v in self.sim_dict.to_arrays().items()}
+        else:
+            sim_dict = self.sim_dict.copy()
+            sim_dict.sum_duplicates()
+            index_dtype = np.int32 if sim_dict.nnz < np.iinfo(np.int32).max \
+                else np.int64
+            arrays = {
+                'data': sim_dict.data,
+                'indices': sim_dict.indices.astype(index_dtype),
+                'indptr': sim_dict.indptr.astype(index_dtype),
+                'shape': np.array(sim_dict.shape),
+            }
+        arrays['all_cpts'] = np.asarray(self.all_cpts, dtype=str)
+        for k, v in self.cpt_inds.to_arrays().items():
+            arrays['cpt_inds/' + k] = v
+        return SharedArrays.create(arrays)
+
+    @classmethod
+    def from_shared(cls, shared):
+        """
+        :param shared: thesaurus.shared.SharedArrays or its `handle`
+        :return: SoftCosineCombinedSimilarity backed by the shared arrays
+        """
+        from thesaurus.shared import SharedArrays
+        if not isinstance(shared, SharedArrays):
+            shared = SharedArrays.attach(shared)
+        sim = cls.__new__(cls)
+        sim._init_caches()
+        sim._attach(shared)
+        return sim
+
+    def _init_caches(self):
+        # Per process state, also set up for instances from `from_shared`
+        self._expansion = None
+        self._expansion_key = None
+        self._term_vocabulary = TermVocabulary()
+
+    def _attach(self, shared):
+        if 'quantized/data' in shared.arrays:
+            sim_dict = QuantizedSimDict.from_arrays({
+                k[len('quantized/'):]: v for k, v in shared.arrays.items()
+                if k.startswith('quantized/')
+            })
+        else:
+            sim_dict = csr_matrix(
+                (shared['data'], shared['indices'], shared['indptr']),
+                shape=tuple(shared['shape']), copy=False
+            )
+            sim_dict.has_canonical_format = True
+        self.sim_dict = sim_dict
+        self.all_cpts = shared['all_cpts']
+        self.cpt_inds = UriIndex(sorted_uris=shared['cpt_inds/sorted_uris'],
+                                 order=shared['cpt_inds/order'])
+        self.shared = shared
 
     def compute(self, v1, v2):
         """
 
-        :param v1: (concept array, term-multi-set) of document 1
+        :param v1: (concept array, term-multi-set) of document 1; the
+            term-multi-set is a Counter or a `transform_term_vectors` row
         :param v2: (concept array, term-multi-set) of document 2
         :return:
         """
@@ -107,17 +391,38 @@ class SoftCosineCombinedSimilarity:
 
         cpt_sim = self.compute_cpts(cpt_vect1, cpt_vect2)
 
-        term_sim_den = sum((termset1 | termset2).values())
-        if term_sim_den == 0:
-            term_sim = 0
+        if scipy.sparse.issparse(termset1):
+            term_sim = self.compute_terms(termset1, termset2)
         else:
-            term_sim_num = sum((termset1 & termset2).values())
-            term_sim = term_sim_num / term_sim_den
+            term_sim_den = sum((termset1 | termset2).values())
+            if term_sim_den == 0:
+                term_sim = 0
+            else:
+                term_sim_num = sum((termset1 & termset2).values())
+                term_sim = term_sim_num / term_sim_den
         root_logger.info(
             'Terms done, time: {:0.3f}'.format(time() - start))
 
         return cpt_sim, term_sim
 
+    def compute_terms(self, term_vect1, term_vect2):
+        """
+        :param term_vect1: term vector from `transform_term_vectors`
+        :param term_vect2: same
+        :return: weighted Jaccard similarity of the term multi-sets
+        """
+        return float(weighted_jaccard_matrix(term_vect1, term_vect2)[0, 0])
+
+    def compute_terms_many(self, docs1, docs2=None, block_size=10):
+        """
+        :param docs1: matrix of term vectors from `transform_term_vectors`,
+            e.g. the queries
+        :param docs2: same, e.g. the corpus; `docs1` if None
+        :param block_size: see `weighted_jaccard_matrix`
+        :return: np.ndarray of the weighted Jaccard similarities of all pairs
+        """
+        return weighted_jaccard_matrix(docs1, docs2, block_size=block_size)
+
     def compute_cpts(self, cpt_vect1, cpt_vect2):
         start = time()
 
@@ -126,18 +431,64 @@ class SoftCosineCombinedSimilarity:
             'Cpts done, time: {:0.3f}'.format(time() - start))
         return cpt_sim
 
+    def compute_cpts_many(self, docs1, docs2=None):
+        """
+        :param docs1: matrix of concept vectors from `transform_cpts_many`
+        :param docs2: same, `docs1` if None
+        :return: np.ndarray of the soft cosines of all pairs
+        """
+        return soft_cosine_matrix(docs1, docs2, self.sim_dict)
+
     def transform_cpts(self, cpt_dict):
         """
         :param cpt_dict: {cpt_uri: cpt_freq} all cpt_uris should be contained in self.all_cpts
         :return: scipy.sparse.csr_matrix
         """
         vect = np.zeros(len(self.all_cpts))
-        for cpt_uri, cpt_freq in cpt_dict.items():
-            cpt_ind = self.cpt_inds[cpt_uri]
-            vect[cpt_ind] = cpt_freq
+        vect[self.cpt_inds.indices(cpt_dict.keys())] = list(cpt_dict.values())
         vect = scipy.sparse.csr_matrix(vect)
         return vect
 
+    def transform_cpts_many(self, cpt_dicts):
+        """
+        :param cpt_dicts: iterable of {cpt_uri: cpt_freq}
+        :return: scipy.sparse.csr_matrix, one document per row
+        """
+        indptr = [0]
+        indices = []
+        data = []
+        for cpt_dict in cpt_dicts:
+            indices.append(self.cpt_inds.indices(cpt_dict.keys()))
+            data.append(np.fromiter(cpt_dict.values(), dtype=np.float64,
+                                    count=len(cpt_dict)))
+            indptr.append(indptr[-1] + len(cpt_dict))
+        docs = csr_matrix(
+            (np.concatenate(data + [np.zeros(0)]),
+             np.concatenate(indices + [np.zeros(0, dtype=np.int64)]),
+             indptr),
+            shape=(len(indptr) - 1, len(self.all_cpts))
+        )
+        docs.sum_duplicates()
+        return docs
+
+    def expand_cpts(self, docs, compiled, decay=0.5, max_depth=None):
+        """
+        Let the concepts of the documents count for their broader concepts
+        as well, see CompiledThesaurus.expansion_matrix.
+
+        :param docs: matrix from `transform_cpts_many` or a `transform_cpts`
+            vector
+        :param compiled: thesaurus.compiled.CompiledThesaurus of the thesaurus
+            of `self.sim_dict`
+        :return: scipy.sparse.csr_matrix
+        """
+        if self._expansion_key != (compiled.version, decay, max_depth):
+            self._expansion = compiled.expansion_matrix(
+                decay=decay, max_depth=max_depth, cpt_uris=self.all_cpts
+            )
+            self._expansion_key = (compiled.version, decay, max_depth)
+        return csr_matrix(docs @ self._expansion)
+
     @staticmethod
     def transform_terms(term_dict):
         """
@@ -147,6 +498,20 @@ class SoftCosineCombinedSimilarity:
         termset = Counter(term_dict)
         return termset
 
+    @property
+    def term_vocabulary(self):
+        return self._term_vocabulary
+
+    def transform_term_vectors(self, term_dicts):
+        """
+        Vectorized counterpart of `transform_terms` for many documents.
+
+        :param term_dicts: iterable of {term: term_freq}
+        :return: scipy.sparse.csr_matrix, one document per row, over the
+            vocabulary of this instance
+        """
+        return self.term_vocabulary.transform_many(term_dicts)
+
 
 if __name__ == '__main__':
     pass
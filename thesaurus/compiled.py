@@ -0,0 +1,527 @@
+"""
+Array snapshot of a thesaurus.
+
+Walking the rdflib graph concept by concept is the bottleneck of most bulk
+operations on a thesaurus. `CompiledThesaurus` keeps the concept URIs (sorted,
+so that the position in the array is the concept id), the `skos:broader`
+(and, optionally, `skos:narrower`) adjacency as CSR arrays, frequencies and
+preferred labels in numpy arrays. Snapshots only depend on numpy and scipy
+and can be saved next to the serialized thesaurus.
+"""
+import os
+import hashlib
+import logging
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+
+logger = logging.getLogger(__name__)
+
+
+def lookup_sorted(sorted_uris, uris):
+    """
+    Find `uris` in the sorted array `sorted_uris`.
+
+    :return: (positions, found) arrays; positions are meaningless where
+        found is False
+    """
+    uris = np.asarray(uris, dtype=str)
+    if len(sorted_uris) == 0:
+        return np.zeros(len(uris), dtype=np.int64), np.zeros(len(uris), bool)
+    inds = np.searchsorted(sorted_uris, uris)
+    inds = np.minimum(inds, len(sorted_uris) - 1)
+    return inds, sorted_uris[inds] == uris
+
+
+class UriIndex:
+    """
+    Read-only mapping from URIs to their positions in a list of URIs.
+
+    Backed by two arrays (the sorted URIs and their positions) instead of a
+    dict, so that it can be shared between processes.
+    """
+
+    def __init__(self, uris=None, sorted_uris=None, order=None):
+        if sorted_uris is None:
+            uris = np.asarray(uris, dtype=str)
+            order = np.argsort(uris, kind='stable')
+            sorted_uris = uris[order]
+        self.sorted_uris = sorted_uris
+        self.order = order
+
+    def __len__(self):
+        return len(self.sorted_uris)
+
+    def __contains__(self, uri):
+        return bool(lookup_sorted(self.sorted_uris, [str(uri)])[1][0])
+
+    def __getitem__(self, uri):
+        inds, found = lookup_sorted(self.sorted_uris, [str(uri)])
+        if not found[0]:
+            raise KeyError(uri)
+        return int(self.order[inds[0]])
+
+    def get(self, uri, default=None):
+        try:
+            return self[uri]
+        except KeyError:
+            return default
+
+    def indices(self, uris):
+        """
+        :param uris: iterable of URIs
+        :return: np.ndarray of positions
+        """
+        uris = np.asarray([str(x) for x in uris], dtype=str)
+        inds, found = lookup_sorted(self.sorted_uris, uris)
+        if not found.all():
+            raise KeyError(uris[~found][0])
+        return self.order[inds]
+
+    def to_arrays(self):
+        return {'sorted_uris': self.sorted_uris, 'order': self.order}
+
+
+class CompiledThesaurus:
+    """
+    Read-only array view of a :class:`thesaurus.thesaurus.Thesaurus`.
+
+    Concept ids are positions in the sorted `cpt_uris` array. Missing
+    frequencies are stored as NaN.
+    """
+
+    def __init__(self, cpt_uris, broader_indptr, broader_indices,
+                 own_freqs, cum_freqs, pref_labels, top_uri=':T',
+                 layout=None, layout_version=None, narrower_indptr=None,
+                 narrower_indices=None):
+        self.cpt_uris = np.asarray(cpt_uris, dtype=str)
+        self.broader_indptr = np.asarray(broader_indptr, dtype=np.int32)
+        self.broader_indices = np.asarray(broader_indices, dtype=np.int32)
+        self.own_freqs = np.asarray(own_freqs, dtype=np.float64)
+        self.cum_freqs = np.asarray(cum_freqs, dtype=np.float64)
+        self.pref_labels = np.asarray(pref_labels, dtype=str)
+        # Snapshots saved before the narrower links were stored do not have
+        # them, see `narrower_matrix`
+        self.narrower_indptr = None
+        self.narrower_indices = None
+        if narrower_indptr is not None:
+            self.narrower_indptr = np.asarray(narrower_indptr, dtype=np.int32)
+            self.narrower_indices = np.asarray(narrower_indices,
+                                               dtype=np.int32)
+        self.top_uri = str(top_uri)
+        self.top_ind = self.index(self.top_uri)
+        self._layout = layout
+        self._layout_version = layout_version
+        self._version = None
+        self._tree = None
+        self._ancestors = None
+        # thesaurus.shared.SharedArrays backing the arrays, see `from_shared`
+        self.shared = None
+
+    def __len__(self):
+        return len(self.cpt_uris)
+
+    def __contains__(self, cpt_uri):
+        return bool(lookup_sorted(self.cpt_uris, [str(cpt_uri)])[1][0])
+
+    def __str__(self):
+        return 'CompiledThesaurus({} concepts)'.format(len(self))
+
+    @property
+    def version(self):
+        """
+        Hash of the concepts and the broader links. Frequencies and labels are
+        not included: the version identifies the shape of the hierarchy.
+        """
+        if self._version is None:
+            h = hashlib.sha1()
+            h.update('\n'.join(self.cpt_uris.tolist()).encode('utf-8'))
+            h.update(self.broader_indptr.tobytes())
+            h.update(self.broader_indices.tobytes())
+            self._version = h.hexdigest()[:16]
+        return self._version
+
+    def index(self, cpt_uri):
+        """
+        :param cpt_uri: concept URI
+        :return: concept id
+        """
+        inds, found = lookup_sorted(self.cpt_uris, [str(cpt_uri)])
+        if not found[0]:
+            raise KeyError(cpt_uri)
+        return int(inds[0])
+
+    def indices(self, cpt_uris):
+        """
+        Vectorized version of `index`.
+
+        :param cpt_uris: iterable of concept URIs
+        :return: np.ndarray of concept ids
+        """
+        cpt_uris = np.asarray([str(x) for x in cpt_uris], dtype=str)
+        inds, found = lookup_sorted(self.cpt_uris, cpt_uris)
+        if not found.all():
+            raise KeyError(cpt_uris[~found][0])
+        return inds
+
+    @property
+    def broader_matrix(self):
+        """
+        :return: scipy.sparse.csr_matrix whose i,j entry is 1 if j is broader
+            than i
+        """
+        n = len(self)
+        data = np.ones(len(self.broader_indices), dtype=np.int8)
+        return scipy.sparse.csr_matrix(
+            (data, self.broader_indices, self.broader_indptr), shape=(n, n)
+        )
+
+    @property
+    def narrower_matrix(self):
+        """
+        :return: scipy.sparse.csr_matrix whose i,j entry is 1 if the
+            thesaurus states that j is narrower than i; the transpose of
+            `broader_matrix` if the narrower links were not compiled
+        """
+        if self.narrower_indptr is None:
+            return self.broader_matrix.T.tocsr()
+        n = len(self)
+        data = np.ones(len(self.narrower_indices), dtype=np.int8)
+        return scipy.sparse.csr_matrix(
+            (data, self.narrower_indices, self.narrower_indptr), shape=(n, n)
+        )
+
+    def ancestor_matrix(self):
+        """
+        Reflexive transitive closure of `broader_matrix`, computed level by
+        level with one sparse product per level of the hierarchy.
+
+        :return: scipy.sparse.csr_matrix whose i,j entry is 1 + the length of
+            the shortest broader path from i to j, and 0 if j is not an
+            ancestor of i. The diagonal is 1.
+        """
+        if self._ancestors is None:
+            broader = self.broader_matrix.astype(np.int32)
+            reached = scipy.sparse.identity(len(self), dtype=np.int32,
+                                            format='csr')
+            dist = reached.copy()
+            frontier = reached
+            d = 1
+            while frontier.nnz:
+                d += 1
+                step = frontier @ broader
+                step.data[:] = 1
+                frontier = step - step.multiply(reached)
+                frontier.eliminate_zeros()
+                reached = reached + frontier
+                dist = dist + frontier * d
+            dist.sort_indices()
+            self._ancestors = dist
+        return self._ancestors
+
+    def expansion_matrix(self, decay=0.5, max_depth=None, include_top=False,
+                         cpt_uris=None):
+        """
+        Decay weighted ancestor matrix. Multiplying a document by concept
+        matrix with it propagates every mention of a concept to its broader
+        concepts: the concept k levels up gets `decay ** k` of the frequency.
+
+        :param decay: weight per level
+        :param max_depth: number of levels to propagate, all if None
+        :param include_top: propagate to the top concept as well
+        :param cpt_uris: order of the rows and columns, e.g. the `all_cpts` of
+            a similarity matrix; the order of `cpt_uris` by default
+        :return: scipy.sparse.csr_matrix
+        """
+        ancestors = self.ancestor_matrix().tocoo()
+        dist = ancestors.data - 1
+        keep = np.ones(len(dist), dtype=bool)
+        if max_depth is not None:
+            keep &= dist <= max_depth
+        if not include_top:
+            keep &= (ancestors.col != self.top_ind) | (dist == 0)
+        expansion = scipy.sparse.csr_matrix(
+            (np.power(float(decay), dist[keep]),
+             (ancestors.row[keep], ancestors.col[keep])),
+            shape=ancestors.shape
+        )
+        if cpt_uris is not None:
+            order = self.indices(cpt_uris)
+            expansion = expansion[order][:, order]
+        return expansion
+
+    def get_own_freqs(self, def_value=1):
+        return np.where(np.isnan(self.own_freqs), def_value, self.own_freqs)
+
+    def get_cumulative_freqs(self, def_value=1):
+        return np.where(np.isnan(self.cum_freqs), def_value, self.cum_freqs)
+
+    def tree(self):
+        """
+        Breadth first spanning tree of the hierarchy rooted in the top concept.
+
+        :return: (parent, depth) arrays. Concepts not reachable from the top
+            concept have parent -1 and depth -1, the top concept has parent -1
+            and depth 0.
+        """
+        if self._tree is None:
+            narrower = self.broader_matrix.T.tocsr()
+            dist, pred = scipy.sparse.csgraph.shortest_path(
+                narrower, indices=self.top_ind, unweighted=True,
+                return_predecessors=True
+            )
+            reachable = np.isfinite(dist)
+            depth = np.where(reachable, dist, -1).astype(np.int32)
+            parent = np.where(pred < 0, -1, pred).astype(np.int32)
+            self._tree = parent, depth
+        return self._tree
+
+    def _attached_tree(self):
+        # The spanning tree with unreachable concepts hung below the top
+        parent, depth = self.tree()
+        orphans = depth < 0
+        parent = np.where(orphans, self.top_ind, parent)
+        depth = np.where(orphans, 1, depth)
+        parent[self.top_ind] = -1
+        return parent, depth
+
+    def layout(self):
+        """
+        Radial tree layout similar to Graphviz `twopi`: the top concept is in
+        the center, every concept lies on the circle of its depth and gets an
+        angular sector proportional to the number of leaves below it.
+
+        The layout is computed once per `version` and saved with the snapshot.
+
+        :return: np.ndarray of shape (n, 2) with the positions of the concepts
+        """
+        if self._layout is not None and self._layout_version == self.version:
+            return self._layout
+        parent, depth = self._attached_tree()
+        n = len(self)
+        max_depth = depth.max(initial=0)
+
+        has_children = np.zeros(n, dtype=bool)
+        has_children[parent[parent >= 0]] = True
+        width = np.where(has_children, 0., 1.)
+        for d in range(max_depth, 0, -1):
+            level = np.flatnonzero(depth == d)
+            np.add.at(width, parent[level], width[level])
+
+        start = np.zeros(n)
+        span = np.zeros(n)
+        span[self.top_ind] = 2 * np.pi
+        for d in range(1, max_depth + 1):
+            level = np.flatnonzero(depth == d)
+            level = level[np.argsort(parent[level], kind='stable')]
+            level_parent = parent[level]
+            w = width[level]
+            cum_w = np.cumsum(w)
+            # offset of every sibling inside the sector of its parent
+            group_first = np.r_[True, level_parent[1:] != level_parent[:-1]]
+            first_pos = np.maximum.accumulate(
+                np.where(group_first, np.arange(len(level)), 0)
+            )
+            offset = (cum_w - w) - (cum_w - w)[first_pos]
+            share = span[level_parent] / width[level_parent]
+            start[level] = start[level_parent] + offset * share
+            span[level] = w * share
+
+        angle = start + span / 2
+        self._layout = np.column_stack([depth * np.cos(angle),
+                                        depth * np.sin(angle)])
+        self._layout_version = self.version
+        return self._layout
+
+    def level_of_detail(self, max_nodes):
+        """
+        Collapse deep subtrees so that at most `max_nodes` concepts are shown.
+
+        :param max_nodes: maximal number of visible concepts
+        :return: (representative, max_depth): for every concept the id of the
+            visible concept it is collapsed into, and the deepest visible level
+        """
+        parent, depth = self._attached_tree()
+        per_level = np.cumsum(np.bincount(depth))
+        max_depth = max(int(np.searchsorted(per_level, max_nodes, 'right')) - 1,
+                        1)
+        representative = np.arange(len(self))
+        deep = np.flatnonzero(depth > max_depth)
+        while len(deep):
+            representative[deep] = parent[representative[deep]]
+            deep = deep[depth[representative[deep]] > max_depth]
+        return representative, max_depth
+
+    def to_arrays(self):
+        arrays = {
+            'cpt_uris': self.cpt_uris,
+            'broader_indptr': self.broader_indptr,
+            'broader_indices': self.broader_indices,
+            'own_freqs': self.own_freqs,
+            'cum_freqs': self.cum_freqs,
+            'pref_labels': self.pref_labels,
+            'top_uri': np.array(self.top_uri),
+        }
+        if self.narrower_indptr is not None:
+            arrays['narrower_indptr'] = self.narrower_indptr
+            arrays['narrower_indices'] = self.narrower_indices
+        if self._layout is not None:
+            arrays['layout'] = self._layout
+            arrays['layout_version'] = np.array(self._layout_version)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        kwargs = {k: arrays[k] for k in arrays}
+        kwargs['top_uri'] = str(kwargs['top_uri'])
+        if 'layout_version' in kwargs:
+            kwargs['layout_version'] = str(kwargs['layout_version'])
+        return cls(**kwargs)
+
+    def share(self):
+        """
+        Copy the snapshot and its `ancestor_matrix` to shared memory.
+
+        :return: thesaurus.shared.SharedArrays, keep it alive as long as the
+            snapshot is used and pass its `handle` to `from_shared`
+        """
+        from thesaurus.shared import SharedArrays
+        arrays = self.to_arrays()
+        ancestors = self.ancestor_matrix()
+        for k in ['data', 'indices', 'indptr']:
+            arrays['ancestors/' + k] = getattr(ancestors, k)
+        return SharedArrays.create(arrays)
+
+    @classmethod
+    def from_shared(cls, shared):
+        """
+        :param shared: thesaurus.shared.SharedArrays or its `handle`
+        :return: CompiledThesaurus backed by the shared arrays
+        """
+        from thesaurus.shared import SharedArrays
+        if not isinstance(shared, SharedArrays):
+            shared = SharedArrays.attach(shared)
+        arrays = {k: v for k, v in shared.arrays.items()
+                  if not k.startswith('ancestors/')}
+        compiled = cls.from_arrays(arrays)
+        if 'ancestors/indptr' in shared.arrays:
+            n = len(compiled)
+            ancestors = scipy.sparse.csr_matrix(
+                (shared['ancestors/data'], shared['ancestors/indices'],
+                 shared['ancestors/indptr']), shape=(n, n), copy=False
+            )
+            ancestors.has_sorted_indices = True
+            compiled._ancestors = ancestors
+        compiled.shared = shared
+        return compiled
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls.from_arrays({k: arrays[k] for k in arrays.files})
+
+
+def compile_thesaurus(the, lang='en'):
+    """
+    Build a `CompiledThesaurus` from the rdflib graph.
+
+    :param the: Thesaurus
+    :param lang: language of the preferred labels
+    :return: CompiledThesaurus
+    """
+    from rdflib.namespace import SKOS
+
+    cpt_uris = np.array(sorted(str(x) for x in the.get_all_concepts()),
+                        dtype=str)
+    n = len(cpt_uris)
+
+    def adjacency(predicate):
+        edges = [(str(s), str(o))
+                 for s, _, o in the.triples((None, predicate, None))]
+        subjects, objects = (zip(*edges) if edges else ((), ()))
+        rows, rows_ok = lookup_sorted(cpt_uris, list(subjects))
+        cols, cols_ok = lookup_sorted(cpt_uris, list(objects))
+        ok = rows_ok & cols_ok
+        matrix = scipy.sparse.csr_matrix(
+            (np.ones(ok.sum(), dtype=np.int8), (rows[ok], cols[ok])),
+            shape=(n, n)
+        )
+        matrix.sum_duplicates()
+        matrix.sort_indices()
+        return matrix
+
+    broader = adjacency(SKOS.broader)
+    narrower = adjacency(SKOS.narrower)
+
+    def freqs(predicate):
+        values = np.full(n, np.nan)
+        pairs = [(str(s), float(o.toPython()))
+                 for s, _, o in the.triples((None, predicate, None))]
+        if pairs:
+            uris, vals = zip(*pairs)
+            inds, found = lookup_sorted(cpt_uris, list(uris))
+            values[inds[found]] = np.asarray(vals)[found]
+        return values
+
+    pref_labels = the.get_all_concepts_and_pref_labels(lang=lang)
+    compiled = CompiledThesaurus(
+        cpt_uris=cpt_uris,
+        broader_indptr=broader.indptr,
+        broader_indices=broader.indices,
+        narrower_indptr=narrower.indptr,
+        narrower_indices=narrower.indices,
+        own_freqs=freqs(the.own_freq_predicate),
+        cum_freqs=freqs(the.cum_freq_predicate),
+        pref_labels=[pref_labels.get(x, '') for x in cpt_uris],
+        top_uri=the.top_uri,
+    )
+    logger.info('Compiled {}, version {}'.format(compiled, compiled.version))
+    return compiled
+
+
+def get_compiled(snapshot_path, the, refresh=False, lang='en',
+                 with_layout=False):
+    """
+    Compile `the` and reuse the layout stored in the snapshot at
+    `snapshot_path` if the hierarchy did not change since it was saved.
+    Compiling is cheap compared with the layout, so the concepts, frequencies
+    and labels are always those of `the`.
+
+    :param snapshot_path: path to the .npz snapshot, may be None
+    :param the: Thesaurus; if None, the snapshot is loaded as it is
+    :param refresh: ignore an existing snapshot
+    :param with_layout: make sure the snapshot contains the plot layout
+    :return: CompiledThesaurus
+    """
+    stored = None
+    if snapshot_path is not None and os.path.exists(snapshot_path) and \
+            not refresh:
+        logger.info('Snapshot at {} exists, loading'.format(snapshot_path))
+        stored = CompiledThesaurus.load(snapshot_path)
+        if the is None:
+            return stored
+    compiled = compile_thesaurus(the, lang=lang)
+    if stored is not None and stored._layout_version == compiled.version:
+        compiled._layout = stored._layout
+        compiled._layout_version = stored._layout_version
+    if with_layout:
+        compiled.layout()
+    if snapshot_path is not None and not _same_snapshot(stored, compiled):
+        compiled.save(snapshot_path)
+    return compiled
+
+
+def _same_snapshot(stored, compiled):
+    if stored is None:
+        return False
+    old, new = stored.to_arrays(), compiled.to_arrays()
+    return old.keys() == new.keys() and all(
+        np.array_equal(old[k], new[k], equal_nan=old[k].dtype.kind == 'f')
+        for k in old
+    )
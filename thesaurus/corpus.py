@@ -0,0 +1,272 @@
+"""
+Out-of-core soft cosine scoring of document corpora.
+
+A corpus is a directory of CSR shards (document by concept matrices) saved as
+plain .npy arrays, so that they can be memory-mapped. Scoring goes over the
+corpus chunk by chunk on a thread pool and streams the top-k results of every
+query to a TSV file. The threads run in parallel where scipy's sparse
+products and numpy release the GIL; projecting the corpus for its norms with
+a `LazySimDict` or `FederatedSimDict` assembles their rows in Python, which
+holds the GIL.
+"""
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+
+from thesaurus.compare_docs import project
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_shards(chunks, directory):
+    """
+    :param chunks: iterable of scipy.sparse matrices with the same number of
+        columns, every one becomes a shard
+    :param directory: where to write the shards
+    :return: ShardedCorpus
+    """
+    os.makedirs(directory, exist_ok=True)
+    for k, chunk in enumerate(chunks):
+        chunk = scipy.sparse.csr_matrix(chunk)
+        chunk.sum_duplicates()
+        shard_dir = os.path.join(directory, 'shard_{:05d}'.format(k))
+        os.makedirs(shard_dir, exist_ok=True)
+        for name in ['data', 'indices', 'indptr']:
+            np.save(os.path.join(shard_dir, name + '.npy'),
+                    getattr(chunk, name))
+        np.save(os.path.join(shard_dir, 'shape.npy'), np.array(chunk.shape))
+    return ShardedCorpus(directory)
+
+
+def save_shards(docs, directory, shard_size=100000):
+    """
+    Split a document matrix into shards of `shard_size` documents.
+    """
+    docs = scipy.sparse.csr_matrix(docs)
+    return write_shards(
+        (docs[i:i + shard_size] for i in range(0, docs.shape[0], shard_size)),
+        directory
+    )
+
+
+class ShardedCorpus:
+    """
+    Memory-mapped document by concept matrix stored by `write_shards`.
+    Documents are numbered across the shards in order.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.shard_dirs = sorted(
+            os.path.join(directory, x) for x in os.listdir(directory)
+            if x.startswith('shard_')
+        )
+        shapes = [np.load(os.path.join(x, 'shape.npy'))
+                  for x in self.shard_dirs]
+        self.shard_offsets = np.cumsum([0] + [int(x[0]) for x in shapes])
+        self.n_features = int(shapes[0][1]) if shapes else 0
+        self.shape = (int(self.shard_offsets[-1]), self.n_features)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def load_shard(self, k):
+        shard_dir = self.shard_dirs[k]
+        arrays = [np.load(os.path.join(shard_dir, name + '.npy'),
+                          mmap_mode='r')
+                  for name in ['data', 'indices', 'indptr']]
+        shape = (int(self.shard_offsets[k + 1] - self.shard_offsets[k]),
+                 self.n_features)
+        return scipy.sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+    def iter_chunks(self, chunk_size=10000):
+        """
+        :return: generator of (offset of the first document, csr_matrix)
+        """
+        for k in range(len(self.shard_dirs)):
+            shard = self.load_shard(k)
+            for start in range(0, shard.shape[0], chunk_size):
+                yield (int(self.shard_offsets[k]) + start,
+                       scipy.sparse.csr_matrix(shard[start:start + chunk_size]))
+
+
+def _as_chunks(docs, chunk_size):
+    if isinstance(docs, ShardedCorpus):
+        return docs.iter_chunks(chunk_size)
+    docs = scipy.sparse.csr_matrix(docs)
+    return ((i, docs[i:i + chunk_size])
+            for i in range(0, docs.shape[0], chunk_size))
+
+
+def soft_norms(docs, features_similarity):
+    """
+    :return: np.ndarray of the soft norms of the rows of `docs`
+    """
+    proj = scipy.sparse.csr_matrix(project(docs, features_similarity))
+    return np.sqrt(np.asarray(proj.multiply(docs).sum(axis=1)).ravel())
+
+
+def _bounded_map(executor, fn, iterable, window):
+    # Executor.map submits the whole iterable at once, which would read the
+    # whole corpus into memory; keep at most `window` chunks in flight
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _merge_top_k(best_scores, best_ids, scores, ids, top_k):
+    scores = np.concatenate([best_scores, scores], axis=1)
+    ids = np.concatenate([best_ids, ids], axis=1)
+    if scores.shape[1] > top_k:
+        keep = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        scores = np.take_along_axis(scores, keep, axis=1)
+        ids = np.take_along_axis(ids, keep, axis=1)
+    return scores, ids
+
+
+class CorpusScorer:
+    """
+    Top-k soft cosine search over a corpus that does not fit in memory.
+
+    :param sim: SoftCosineCombinedSimilarity or a concept similarity matrix
+    :param corpus: ShardedCorpus or scipy.sparse matrix
+    :param chunk_size: number of documents scored at once per thread; the
+        memory is bounded by n_threads * query chunk * chunk_size scores
+    :param n_threads: size of the thread pool
+    :param progress: optional callback(done documents, total documents)
+    """
+
+    def __init__(self, sim, corpus, chunk_size=10000, n_threads=4,
+                 progress=None):
+        self.features_similarity = getattr(sim, 'sim_dict', sim)
+        self.corpus = corpus
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
+        self.progress = progress
+        self._norms = None
+
+    def corpus_norms(self, executor=None):
+        """
+        Soft norms of all corpus documents, computed in one pass.
+
+        :param executor: thread pool to use, a new one if None
+        """
+        if self._norms is None:
+            if executor is None:
+                with ThreadPoolExecutor(self.n_threads) as executor:
+                    return self.corpus_norms(executor)
+            norms = _bounded_map(
+                executor,
+                lambda x: soft_norms(x[1], self.features_similarity),
+                _as_chunks(self.corpus, self.chunk_size),
+                2 * self.n_threads
+            )
+            self._norms = np.concatenate(list(norms) + [np.zeros(0)])
+        return self._norms
+
+    def _score_chunk(self, query_proj, query_norms, query_ids, chunk,
+                     top_k, exclude_self):
+        offset, docs = chunk
+        doc_ids = np.arange(offset, offset + docs.shape[0])
+        numerator = (query_proj @ docs.T).toarray()
+        denominator = np.outer(query_norms, self._norms[doc_ids])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(denominator != 0, numerator / denominator, 0.)
+        if exclude_self:
+            scores[query_ids[:, None] == doc_ids[None, :]] = -np.inf
+        best = np.full((len(query_ids), 0), -np.inf)
+        return _merge_top_k(best, best.astype(np.int64), scores,
+                            np.broadcast_to(doc_ids, scores.shape), top_k)
+
+    def search(self, queries, top_k=10, out_path=None, min_score=None,
+               query_chunk_size=1000, exclude_self=False):
+        """
+        :param queries: ShardedCorpus or scipy.sparse matrix of query documents
+        :param top_k: number of results per query
+        :param out_path: TSV file to stream the results to, as lines
+            `query id, document id, score`; the results are returned if None
+        :param min_score: drop results below this score
+        :param exclude_self: skip pairs with the same id (for queries that
+            are the corpus itself)
+        :return: list of (query id, document ids, scores) if `out_path` is
+            None
+        """
+        results = []
+        out = open(out_path, 'w') if out_path is not None else None
+        total = len(queries) if isinstance(queries, ShardedCorpus) \
+            else queries.shape[0]
+        done = 0
+        try:
+            with ThreadPoolExecutor(self.n_threads) as executor:
+                self.corpus_norms(executor)
+                for offset, query_docs in _as_chunks(queries,
+                                                     query_chunk_size):
+                    query_ids = np.arange(offset,
+                                          offset + query_docs.shape[0])
+                    query_proj = scipy.sparse.csr_matrix(
+                        project(query_docs, self.features_similarity)
+                    )
+                    query_norms = np.sqrt(np.asarray(
+                        query_proj.multiply(query_docs).sum(axis=1)
+                    ).ravel())
+                    best_scores = np.full((len(query_ids), 0), -np.inf)
+                    best_ids = np.zeros((len(query_ids), 0), dtype=np.int64)
+                    for scores, ids in _bounded_map(
+                            executor,
+                            lambda chunk: self._score_chunk(
+                                query_proj, query_norms, query_ids, chunk,
+                                top_k, exclude_self),
+                            _as_chunks(self.corpus, self.chunk_size),
+                            2 * self.n_threads):
+                        best_scores, best_ids = _merge_top_k(
+                            best_scores, best_ids, scores, ids, top_k
+                        )
+                    order = np.argsort(-best_scores, axis=1, kind='stable')
+                    best_scores = np.take_along_axis(best_scores, order, 1)
+                    best_ids = np.take_along_axis(best_ids, order, 1)
+                    for query_id, ids, scores in zip(query_ids, best_ids,
+                                                     best_scores):
+                        keep = np.isfinite(scores)
+                        if min_score is not None:
+                            keep &= scores >= min_score
+                        if out is None:
+                            results.append((int(query_id), ids[keep],
+                                            scores[keep]))
+                        else:
+                            out.writelines(
+                                '{}\t{}\t{:.6f}\n'.format(query_id, i, s)
+                                for i, s in zip(ids[keep], scores[keep])
+                            )
+                    done += len(query_ids)
+                    logger.info('Scored {} of {} queries'.format(done, total))
+                    if self.progress is not None:
+                        self.progress(done, total)
+        finally:
+            if out is not None:
+                out.close()
+        return results if out is None else None
+
+    def deduplicate(self, threshold, out_path=None, top_k=10,
+                    query_chunk_size=1000):
+        """
+        All pairs search of the corpus against itself, keeping the pairs with
+        a soft cosine of at least `threshold`.
+
+        Only the `top_k` most similar documents of every document are
+        reported: if a document has more than `top_k` duplicates above the
+        threshold, the remaining pairs are dropped. Pairs are reported in
+        both directions.
+        """
+        return self.search(self.corpus, top_k=top_k, out_path=out_path,
+                           min_score=threshold,
+                           query_chunk_size=query_chunk_size,
+                           exclude_self=True)
@@ -0,0 +1,107 @@
+"""
+Structural diff of two compiled thesauri.
+
+Concepts are matched with the sorted URI arrays of the snapshots; broader
+sets and ancestor closures are compared through order-independent 64 bit
+hashes of their concept ids in the union of both URI arrays, so the diff
+is a handful of vectorized passes over the CSR arrays.
+"""
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+def _mix(ids):
+    # splitmix64 finalizer, spreads the ids over all 64 bits
+    x = ids.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _row_hashes(indptr, indices, id_map):
+    """
+    :return: for every row of the CSR arrays the wrapping sum of the mixed
+        `id_map` ids of its columns, which does not depend on their order
+    """
+    mixed = _mix(id_map[indices])
+    cum = np.concatenate([np.zeros(1, np.uint64),
+                          np.cumsum(mixed, dtype=np.uint64)])
+    return cum[indptr[1:]] - cum[indptr[:-1]]
+
+
+class ThesaurusDiff:
+    """
+    Result of `diff_compiled`, all fields are sorted arrays of concept URIs.
+
+    :ivar added: concepts only in the new version
+    :ivar removed: concepts only in the old version
+    :ivar moved: common concepts whose broader concepts changed
+    :ivar relabeled: common concepts whose preferred label changed
+    :ivar closure_changed: common concepts whose set of ancestors changed
+    :ivar freq_changed: common concepts whose cumulative frequency changed
+    """
+
+    fields = ('added', 'removed', 'moved', 'relabeled', 'closure_changed',
+              'freq_changed')
+
+    def __init__(self, added, removed, moved, relabeled, closure_changed,
+                 freq_changed):
+        self.added = added
+        self.removed = removed
+        self.moved = moved
+        self.relabeled = relabeled
+        self.closure_changed = closure_changed
+        self.freq_changed = freq_changed
+
+    def __bool__(self):
+        return any(len(getattr(self, x)) for x in self.fields)
+
+    def __str__(self):
+        return 'ThesaurusDiff({})'.format(', '.join(
+            '{} {}'.format(len(getattr(self, x)), x.replace('_', ' '))
+            for x in self.fields
+        ))
+
+
+def diff_compiled(old, new):
+    """
+    :param old: thesaurus.compiled.CompiledThesaurus
+    :param new: thesaurus.compiled.CompiledThesaurus
+    :return: ThesaurusDiff
+    """
+    union = np.union1d(old.cpt_uris, new.cpt_uris)
+    old_ids = np.searchsorted(union, old.cpt_uris)
+    new_ids = np.searchsorted(union, new.cpt_uris)
+    common, old_common, new_common = np.intersect1d(
+        old.cpt_uris, new.cpt_uris, assume_unique=True, return_indices=True
+    )
+
+    def changed(old_values, new_values):
+        return common[old_values[old_common] != new_values[new_common]]
+
+    old_ancestors = old.ancestor_matrix()
+    new_ancestors = new.ancestor_matrix()
+    old_cum = old.cum_freqs[old_common]
+    new_cum = new.cum_freqs[new_common]
+    same_freq = (old_cum == new_cum) | (np.isnan(old_cum) & np.isnan(new_cum))
+
+    result = ThesaurusDiff(
+        added=np.setdiff1d(new.cpt_uris, common, assume_unique=True),
+        removed=np.setdiff1d(old.cpt_uris, common, assume_unique=True),
+        moved=changed(
+            _row_hashes(old.broader_indptr, old.broader_indices, old_ids),
+            _row_hashes(new.broader_indptr, new.broader_indices, new_ids)
+        ),
+        relabeled=changed(old.pref_labels, new.pref_labels),
+        closure_changed=changed(
+            _row_hashes(old_ancestors.indptr, old_ancestors.indices, old_ids),
+            _row_hashes(new_ancestors.indptr, new_ancestors.indices, new_ids)
+        ),
+        freq_changed=common[~same_freq],
+    )
+    logger.info(str(result))
+    return result
@@ -0,0 +1,215 @@
+"""
+Several thesauri in one concept space.
+
+Every project keeps its compiled snapshot and its own similarity matrix.
+`FederatedThesaurus` gives the concepts of the projects disjoint id ranges
+and assembles the rows of the block diagonal similarity matrix (plus the
+cross-project links) on demand, so adding a project does not recompute the
+similarities of the others.
+"""
+import logging
+
+import numpy as np
+import scipy.sparse
+
+from thesaurus.compiled import CompiledThesaurus, UriIndex
+from thesaurus.sim_dict import RowSimDict, LazySimDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class FederatedSimDict(RowSimDict):
+    """
+    Block diagonal similarity matrix of a `FederatedThesaurus`. The rows are
+    taken from the similarity matrices of the projects; `links` holds the
+    similarities between concepts of different projects.
+    """
+
+    def __init__(self, blocks, offsets, links):
+        self.blocks = blocks
+        self.offsets = offsets
+        self.links = links
+        self.shape = (int(offsets[-1]), int(offsets[-1]))
+
+    def rows(self, inds):
+        """
+        :param inds: global concept ids
+        :return: scipy.sparse.csr_matrix of shape (len(inds), n)
+        """
+        inds = np.asarray(inds, dtype=np.int64).ravel()
+        owners = np.searchsorted(self.offsets, inds, side='right') - 1
+        parts = [self.links[inds].tocoo()]
+        positions = [parts[0].row]
+        for k in np.unique(owners):
+            pos = np.flatnonzero(owners == k)
+            local = inds[pos] - self.offsets[k]
+            block = self.blocks[k]
+            if isinstance(block, RowSimDict):
+                block_rows = block.rows(local)
+            else:
+                block_rows = block[local]
+            block_rows = block_rows.tocoo()
+            block_rows.col = block_rows.col + self.offsets[k]
+            parts.append(block_rows)
+            positions.append(pos[block_rows.row])
+        return scipy.sparse.csr_matrix(
+            (np.concatenate([p.data for p in parts]),
+             (np.concatenate(positions),
+              np.concatenate([p.col for p in parts]))),
+            shape=(len(inds), self.shape[1])
+        )
+
+
+class FederatedThesaurus:
+    """
+    Container of compiled thesauri with disjoint concept id ranges.
+
+    The synthetic top concepts (URIs starting with ':') are prefixed with the
+    project name, e.g. 'geo:T'. A concept URI that occurs in several projects
+    gets an id in each of them; `index` and `SoftCosineCombinedSimilarity`
+    resolve it to the first project that contains it, the other copies are
+    only reachable through the links.
+
+    Use `sim_dict` and `cpt_uris` as `sim_dict` and `all_cpts` of
+    `thesaurus.compare_docs.SoftCosineCombinedSimilarity`.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.projects = []
+        self.sim_dicts = []
+        self._links = []
+        self._sim_dict = None
+        self._cpt_uris = None
+        self._cpt_inds = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __str__(self):
+        return 'FederatedThesaurus({} projects, {} concepts)'.format(
+            len(self.projects), len(self))
+
+    @property
+    def offsets(self):
+        return np.cumsum([0] + [len(x) for x in self.projects])
+
+    def add(self, name, the, sim_dict=None, lang='en', link_exact_matches=True):
+        """
+        :param name: project name, unique in the federation
+        :param the: Thesaurus or CompiledThesaurus
+        :param sim_dict: similarity matrix of the project in the order of
+            its compiled concepts (scipy.sparse, np.ndarray or
+            thesaurus.sim_dict.RowSimDict); a LazySimDict by default
+        :param link_exact_matches: link the `skos:exactMatch` pairs of a
+            Thesaurus with similarity 1, see `add_links`
+        """
+        if name in self.names:
+            raise ValueError('Project {} already exists'.format(name))
+        compiled = the if isinstance(the, CompiledThesaurus) \
+            else the.compile(lang=lang)
+        if sim_dict is None:
+            sim_dict = LazySimDict(compiled)
+        elif not isinstance(sim_dict, RowSimDict):
+            sim_dict = scipy.sparse.csr_matrix(sim_dict)
+        if sim_dict.shape != (len(compiled), len(compiled)):
+            raise ValueError('sim_dict does not match the concepts of '
+                             '{}'.format(name))
+        self.names.append(name)
+        self.projects.append(compiled)
+        self.sim_dicts.append(sim_dict)
+        self._invalidate()
+        if link_exact_matches and not isinstance(the, CompiledThesaurus):
+            from rdflib.namespace import SKOS
+            self.add_links([(str(s), str(o)) for s, _, o in
+                            the.triples((None, SKOS.exactMatch, None))])
+        logger.info('Added {} to {}'.format(name, self))
+
+    def add_links(self, pairs, weight=1.):
+        """
+        Cross-project similarities, e.g. from `skos:exactMatch`. Pairs whose
+        concepts are not (yet) in the federation are kept and used as soon as
+        both concepts are added.
+
+        :param pairs: iterable of (cpt_uri, cpt_uri)
+        :param weight: similarity of the linked concepts
+        """
+        self._links.extend((str(a), str(b), float(weight)) for a, b in pairs)
+        self._sim_dict = None
+
+    def _invalidate(self):
+        self._sim_dict = None
+        self._cpt_uris = None
+        self._cpt_inds = None
+
+    def _global_uris(self, name, compiled):
+        uris = compiled.cpt_uris.astype(object)
+        synthetic = np.char.startswith(compiled.cpt_uris, ':')
+        uris[synthetic] = [name + x for x in compiled.cpt_uris[synthetic]]
+        return uris
+
+    @property
+    def cpt_uris(self):
+        """
+        :return: np.ndarray of the concept URIs in the order of the global ids
+        """
+        if self._cpt_uris is None:
+            self._cpt_uris = np.concatenate(
+                [self._global_uris(n, c).astype(str)
+                 for n, c in zip(self.names, self.projects)] +
+                [np.zeros(0, dtype=str)]
+            )
+            self._cpt_inds = UriIndex(self._cpt_uris)
+        return self._cpt_uris
+
+    def index(self, cpt_uri):
+        """
+        :return: global id of `cpt_uri`, see `cpt_uris`
+        """
+        self.cpt_uris
+        return self._cpt_inds[cpt_uri]
+
+    def project_of(self, i):
+        """
+        :param i: global concept id
+        :return: (project name, concept id in the project)
+        """
+        k = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return self.names[k], int(i - self.offsets[k])
+
+    def link_matrix(self):
+        """
+        :return: symmetric scipy.sparse.csr_matrix of the links between
+            concepts of different projects
+        """
+        n = len(self)
+        offsets = self.offsets
+        self.cpt_uris
+        rows, cols, data = [], [], []
+        for a, b, weight in self._links:
+            i, j = self._cpt_inds.get(a), self._cpt_inds.get(b)
+            if i is None or j is None or \
+                    np.searchsorted(offsets, i, side='right') == \
+                    np.searchsorted(offsets, j, side='right'):
+                continue
+            rows += [i, j]
+            cols += [j, i]
+            data += [weight, weight]
+        links = scipy.sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+        links.sum_duplicates()
+        links.data = np.minimum(links.data, 1.)
+        return links
+
+    @property
+    def sim_dict(self):
+        """
+        Block diagonal similarity matrix over `cpt_uris`, assembled lazily and
+        cached until the next `add` or `add_links`.
+
+        :return: FederatedSimDict
+        """
+        if self._sim_dict is None:
+            self._sim_dict = FederatedSimDict(list(self.sim_dicts),
+                                              self.offsets, self.link_matrix())
+        return self._sim_dict
@@ -0,0 +1,206 @@
+"""
+Concurrent loading of thesauri and concept frequencies from PoolParty.
+
+`PoolPartyLoader` talks to the PoolParty export API and to the corpus analysis
+SPARQL endpoint over one pooled `requests.Session` with retries, downloads the
+export and the frequencies of a project at the same time and can load many
+projects in parallel.
+"""
+import csv
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import rdflib
+
+from thesaurus.thesaurus import Thesaurus, CPT_FREQS_QUERY, iter_cpt_freqs
+
+
+logger = logging.getLogger(__name__)
+
+
+class PoolPartyLoader:
+    """
+    Thread pool based loader.
+
+    :param server: PoolParty server, e.g. 'https://pp.example.com'
+    :param auth_data: (username, password)
+    :param max_workers: number of concurrent requests
+    :param retries: number of retries of failed requests, with exponential
+        backoff of `backoff_factor` seconds
+    :param timeout: (connect, read) timeout of a request in seconds
+    :param validate: check the hierarchy of every loaded thesaurus
+    :param repair: repair it before the frequencies are propagated, see
+        `Thesaurus.validate`
+    """
+    export_url = '{server}/PoolParty/api/projects/{pid}/export'
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, server=None, auth_data=None, max_workers=4,
+                 retries=3, backoff_factor=0.5, timeout=(10, 600),
+                 the_cls=Thesaurus, validate=True, repair=False):
+        self.validate = validate
+        self.repair = repair
+        self.server = server.rstrip('/') if server else server
+        self.timeout = timeout
+        self.the_cls = the_cls
+        self.session = requests.Session()
+        self.session.auth = tuple(auth_data) if auth_data else None
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=self.retry_statuses,
+                      allowed_methods=None,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=max_workers,
+                              pool_maxsize=max_workers,
+                              max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def export_project(self, pid, format='N3'):
+        """
+        :param pid: project id
+        :return: the export as bytes
+        """
+        r = self.session.get(
+            self.export_url.format(server=self.server, pid=pid),
+            params={'format': format, 'modules': 'concepts'},
+            timeout=self.timeout,
+        )
+        r.raise_for_status()
+        return r.content
+
+    def query_sparql(self, sparql_endpoint, graph, query):
+        """
+        Run `query` and parse the CSV result while it is being downloaded.
+
+        :return: generator of rows (lists of strings), without the header
+        """
+        r = self.session.post(
+            sparql_endpoint,
+            data={'query': query, 'default-graph-uri': graph},
+            headers={'Accept': 'text/csv'},
+            timeout=self.timeout,
+            stream=True,
+        )
+        try:
+            r.raise_for_status()
+            r.encoding = 'utf-8'
+            reader = csv.reader(r.iter_lines(decode_unicode=True))
+            next(reader, None)
+            yield from reader
+        finally:
+            r.close()
+
+    def query_cpt_freqs(self, sparql_endpoint, cpt_occur_graph):
+        """
+        Same as :func:`thesaurus.thesaurus.query_cpt_freqs`.
+        """
+        results = dict()
+        for _, label, freq, cpt in self.query_sparql(sparql_endpoint,
+                                                     cpt_occur_graph,
+                                                     CPT_FREQS_QUERY):
+            results[rdflib.URIRef(cpt)] = {
+                'frequency': float(freq),
+                'mainLabel': label
+            }
+        return results
+
+    def iter_cpt_freqs(self, sparql_endpoint, cpt_occur_graph,
+                       page_size=10000, with_labels=False):
+        """
+        Same as :func:`thesaurus.thesaurus.iter_cpt_freqs`.
+        """
+        return iter_cpt_freqs(sparql_endpoint, cpt_occur_graph,
+                              page_size=page_size, with_labels=with_labels,
+                              query_sparql=self.query_sparql)
+
+    def submit_project(self, pid, sparql_endpoint=None, cpt_freq_graph=None,
+                       page_size=10000):
+        """
+        Start downloading the export and, if `sparql_endpoint` is given, the
+        frequencies of project `pid`.
+
+        :return: (export future, generator of the frequency batches or
+            None). The first page is fetched right away, every further page
+            while the previous one is propagated.
+        """
+        export = self.executor.submit(self.export_project, pid)
+        cpt_freqs = None
+        if sparql_endpoint is not None:
+            pages = self.iter_cpt_freqs(sparql_endpoint, cpt_freq_graph,
+                                        page_size=page_size)
+            cpt_freqs = self._prefetch(
+                pages, self.executor.submit(next, pages, None)
+            )
+        return export, cpt_freqs
+
+    def _prefetch(self, pages, next_page):
+        # At most one page is held in memory besides the one being consumed
+        while True:
+            page = next_page.result()
+            if page is None:
+                return
+            next_page = self.executor.submit(next, pages, None)
+            yield page
+
+    def _build(self, export, cpt_freqs):
+        the = self.the_cls()
+        the.parse_export(data=export.result())
+        compiled = None
+        if self.validate or self.repair:
+            # The snapshot is reused for the frequencies unless it was repaired
+            compiled = the.compile()
+            report = the.validate(repair=self.repair, compiled=compiled)
+            if self.repair and not report.is_dag:
+                compiled = None
+        if cpt_freqs is not None:
+            the.add_frequencies_bulk(cpt_freqs, compiled=compiled)
+        else:
+            the.precompute_number_children()
+        return the
+
+    def load_project(self, pid, sparql_endpoint=None, cpt_freq_graph=None):
+        """
+        :return: Thesaurus with frequencies if `sparql_endpoint` is given,
+            otherwise with the number of children as cumulative frequencies
+            (as in `Thesaurus.get_the`)
+        """
+        return self._build(*self.submit_project(pid, sparql_endpoint,
+                                                cpt_freq_graph))
+
+    def load_projects(self, pids, sparql_endpoint=None, cpt_freq_graphs=None):
+        """
+        Download all the projects concurrently.
+
+        :param pids: list of project ids
+        :param cpt_freq_graphs: {pid: cpt_freq_graph}
+        :return: {pid: Thesaurus}
+        """
+        cpt_freq_graphs = cpt_freq_graphs or dict()
+        futures = {
+            pid: self.submit_project(
+                pid,
+                sparql_endpoint if pid in cpt_freq_graphs else None,
+                cpt_freq_graphs.get(pid)
+            )
+            for pid in pids
+        }
+        thes = dict()
+        for pid in pids:
+            logger.info('Building thesaurus {}'.format(pid))
+            thes[pid] = self._build(*futures[pid])
+        return thes
@@ -65,29 +65,45 @@ def plot_linear_regression(x, y, slope, intercept, fig_title='',
 
 
 def plot_taxonomy_coverage(the, fig_title='', show_fig=False, bg_color='white',
-                           div_width=None, div_height=None):
+                           div_width=None, div_height=None,
+                           snapshot_path=None, max_nodes=2000):
+    """
+    Plot the taxonomy tree with concepts colored by their corpus coverage.
+
+    :param the: Thesaurus or thesaurus.compiled.CompiledThesaurus
+    :param snapshot_path: where the compiled snapshot together with its
+        layout is cached, the layout is only recomputed if the hierarchy
+        changed
+    :param max_nodes: subtrees deeper than what fits into `max_nodes` points
+        are collapsed into their ancestors
+    """
+    import numpy as np
     import plotly.offline as po
     import plotly.graph_objs as go
+    from thesaurus.compiled import CompiledThesaurus, get_compiled
 
-    G, pos = the.plot_layout()
-    cpt_uris = the.get_all_concepts()
-    covered = dict()
-    children_covered = dict()
-    for cpt_uri in cpt_uris:
-        cpt_own_freq = int(the.get_own_freq(cpt_uri, def_value=0))
-        cpt_cum_frequency = int(the.get_cumulative_freq(cpt_uri, def_value=0))
-        cpt_pl = str(the.get_pref_label(cpt_uri))
-        if cpt_own_freq:
-            covered[cpt_pl] = cpt_own_freq
-        if cpt_cum_frequency:
-            children_covered[cpt_pl] = cpt_cum_frequency - cpt_own_freq
+    if isinstance(the, CompiledThesaurus):
+        compiled = the
+    else:
+        compiled = get_compiled(snapshot_path, the, with_layout=True)
+    pos = compiled.layout()
+    own_freqs = compiled.get_own_freqs(def_value=0).astype(int)
+    children_freqs = compiled.get_cumulative_freqs(def_value=0).astype(int) \
+        - own_freqs
 
+    representative, _ = compiled.level_of_detail(max_nodes)
+    nodes = np.unique(representative)
+    n_collapsed = np.bincount(representative, minlength=len(compiled)) - 1
 
-    Xe = []
-    Ye = []
-    for edge in G.edges():
-        Xe += [pos[edge[0]][0], pos[edge[1]][0], None]
-        Ye += [pos[edge[0]][1], pos[edge[1]][1], None]
+    broader = compiled.broader_matrix.tocoo()
+    edges = np.unique(np.column_stack([representative[broader.row],
+                                       representative[broader.col]]), axis=0)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    # NaN separates the line segments
+    Xe = np.column_stack([pos[edges[:, 0], 0], pos[edges[:, 1], 0],
+                          np.full(len(edges), np.nan)]).ravel()
+    Ye = np.column_stack([pos[edges[:, 0], 1], pos[edges[:, 1], 1],
+                          np.full(len(edges), np.nan)]).ravel()
 
     lines = go.Scatter(x=Xe,
                        y=Ye,
@@ -95,37 +111,33 @@ def plot_taxonomy_coverage(the, fig_title='', show_fig=False, bg_color='white',
                        line=dict(color='rgb(210,210,210)', width=2),
                        marker=dict(symbol='triangle'),
                        hoverinfo='none')
-    dots = go.Scatter(x=[],
-                      y=[],
+    own = own_freqs[nodes]
+    children = children_freqs[nodes]
+    max_freq = max(own.max(initial=0), 1)
+    labels = np.where(compiled.pref_labels[nodes] != '',
+                      compiled.pref_labels[nodes], compiled.cpt_uris[nodes])
+    node_info = [
+        '{}, own frequency: {}, children frequency: {}'.format(*x) +
+        (', collapsed: {}'.format(x[3]) if x[3] else '')
+        for x in zip(labels, own, children, n_collapsed[nodes])
+    ]
+    dots = go.Scatter(x=pos[nodes, 0],
+                      y=pos[nodes, 1],
                       mode='markers',
                       name='',
                       marker=dict(
                           symbol='dot',
-                          size=[],
-                          color=[],
+                          size=np.where(own > 0, 45 * own / max_freq + 5, 15),
+                          color=np.where(
+                              own > 0, 'blue',
+                              np.where(children > 0, 'orange', 'grey')
+                          ),
                           line=dict(color='rgb(50,50,50)', width=1)
                       ),
-                      text=[],
+                      text=node_info,
                       hoverinfo='text',
                       # opacity=0.8
                       )
-    max_freq = max(covered.values())
-    for node in G.nodes():
-        x, y = pos[node]
-        node_info = '{}, own frequency: {}, children frequency: {}'.format(
-            str(node),
-            covered[node] if node in covered else 0,
-            children_covered[node] if node in children_covered else 0
-        )
-        scaled_size = (45*covered[node]/max_freq + 5) if node in covered else 15
-        dots['x'].append(x)
-        dots['y'].append(y)
-        dots['marker']['color'].append(
-            'blue' if node in covered else
-                ('orange' if node in children_covered else 'grey')
-        )
-        dots['marker']['size'].append(scaled_size)
-        dots['text'].append(node_info)
 
     axis = dict(
         showline=False, zeroline=False, showgrid=False, showticklabels=False
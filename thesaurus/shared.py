@@ -0,0 +1,106 @@
+"""
+Read-only numpy arrays in shared memory.
+
+Used to load the similarity matrix and the compiled thesaurus once in the
+parent process of a pre-fork server and share them with all the workers.
+Forked workers inherit the mapping; other processes `attach` to it by its
+`handle`. The arrays are backed by the shared block itself, so neither
+copy-on-write nor reference counting in the workers duplicates them.
+"""
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+
+ALIGNMENT = 64
+
+
+def _tracker_pid():
+    # Forked children know the pid of the tracker of their parent, spawned
+    # children only inherit the pipe to it and have no pid
+    return resource_tracker._resource_tracker._pid
+
+
+class SharedArrays:
+    """
+    Named numpy arrays in one block of shared memory.
+
+    The process that creates the block owns it and unlinks it on `close`.
+    """
+
+    def __init__(self, shm, spec, owner, tracker_pid=None):
+        self.shm = shm
+        self.spec = spec
+        self.owner = owner
+        # pid of the resource tracker of the owner, None if it was inherited
+        self.tracker_pid = tracker_pid
+        self.arrays = dict()
+        for key, dtype, shape, offset in spec:
+            array = np.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                               offset=offset)
+            array.flags.writeable = False
+            self.arrays[key] = array
+
+    @classmethod
+    def create(cls, arrays):
+        """
+        :param arrays: {name: np.ndarray}
+        :return: SharedArrays with copies of `arrays`
+        """
+        arrays = {k: np.asarray(v, order='C') for k, v in arrays.items()}
+        spec = []
+        size = 0
+        for key, array in arrays.items():
+            offset = -(-size // ALIGNMENT) * ALIGNMENT
+            spec.append((key, array.dtype.str, array.shape, offset))
+            size = offset + array.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for key, dtype, shape, offset in spec:
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                       offset=offset)[...] = arrays[key]
+        return cls(shm, spec, owner=True, tracker_pid=_tracker_pid())
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        :param handle: `handle` of the SharedArrays in another process
+        """
+        name, spec, tracker_pid = handle
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 registers attached blocks with the resource
+            # tracker, which unlinks them when this process exits. Workers
+            # of the owner share its tracker though, unregistering would
+            # drop the registration of the owner.
+            shm = shared_memory.SharedMemory(name=name)
+            if _tracker_pid() not in (None, tracker_pid):
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm, spec, owner=False, tracker_pid=tracker_pid)
+
+    @property
+    def handle(self):
+        """
+        Small picklable reference to the block.
+        """
+        return self.shm.name, self.spec, self.tracker_pid
+
+    @property
+    def nbytes(self):
+        return self.shm.size
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def close(self):
+        if self.owner:
+            self.shm.unlink()
+        self.arrays = dict()
+        try:
+            self.shm.close()
+        except BufferError:
+            # Views are still in use, the mapping goes away with them
+            pass
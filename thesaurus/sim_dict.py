@@ -0,0 +1,272 @@
+"""
+Loading, saving and lazy computation of concept similarity matrices.
+
+Only depends on numpy and scipy, so that processes which score documents
+against a precomputed matrix do not have to import rdflib.
+"""
+import abc
+import pickle
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_sim_dict(sim_dict_path):
+    """
+    Load a matrix saved by `save_sim_dict`.
+
+    :param sim_dict_path: path to the pickle
+    :return: (sim_dict, all_cpts), see `thesaurus.thesaurus.get_sim_dict`
+    """
+    logger.info('Cpt sims at {} exists, loading'.format(sim_dict_path))
+    with open(sim_dict_path, 'rb') as f:
+        unpickled = pickle.load(f)
+    if len(unpickled) != 2:
+        raise ValueError(
+            '{} stores the old dictionary format, load it with '
+            'thesaurus.thesaurus.get_sim_dict'.format(sim_dict_path)
+        )
+    return unpickled
+
+
+def save_sim_dict(sim_dict_path, sim_dict, all_cpts):
+    with open(sim_dict_path, 'wb') as f:
+        pickle.dump((sim_dict, all_cpts), f)
+
+
+class RowSimDict(abc.ABC):
+    """
+    Base of similarity matrices that are not stored as one scipy matrix.
+    Subclasses set `shape` and implement `rows`.
+    """
+    shape = (0, 0)
+
+    @abc.abstractmethod
+    def rows(self, inds):
+        """
+        :param inds: row indices
+        :return: the rows as a scipy.sparse.csr_matrix
+        """
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+            return self[rows][:, cols]
+        if isinstance(key, slice):
+            key = range(*key.indices(self.shape[0]))
+        if np.isscalar(key):
+            return self.rows([key])
+        return self.rows(np.asarray(key).ravel())
+
+    def multiply(self, other):
+        """
+        Point-wise multiplication, only the rows in which `other` has nonzero
+        entries are computed.
+
+        :return: scipy.sparse.csr_matrix
+        """
+        other = scipy.sparse.csr_matrix(other)
+        inds = np.flatnonzero(np.diff(other.indptr))
+        sub = self.rows(inds)
+        indptr = np.zeros(self.shape[0] + 1, dtype=sub.indptr.dtype)
+        indptr[inds + 1] = np.diff(sub.indptr)
+        full = scipy.sparse.csr_matrix(
+            (sub.data, sub.indices, np.cumsum(indptr)), shape=self.shape
+        )
+        return full.multiply(other)
+
+    def rdot(self, docs):
+        """
+        :param docs: scipy.sparse matrix, one document per row
+        :return: docs times the matrix, only the rows of the concepts that
+            occur in `docs` are computed
+        """
+        docs = scipy.sparse.csc_matrix(docs)
+        inds = np.flatnonzero(np.diff(docs.indptr))
+        return docs[:, inds] @ self.rows(inds)
+
+    def toarray(self):
+        return self.rows(range(self.shape[0])).toarray()
+
+
+class LazySimDict(RowSimDict):
+    """
+    Lin similarity matrix of a compiled thesaurus whose rows are computed on
+    first use and kept in a bounded LRU cache.
+
+    Can be passed as `sim_dict` to
+    `thesaurus.compare_docs.SoftCosineCombinedSimilarity` together with
+    `all_cpts`: it supports row slicing (`m[rows]`, `m[rows, cols]`),
+    `multiply`, which is all `soft_cosine` needs, and `rdot` for
+    `soft_cosine_matrix`.
+
+    :param compiled: thesaurus.compiled.CompiledThesaurus
+    :param max_rows: number of cached rows
+    """
+
+    def __init__(self, compiled, max_rows=10000):
+        self.compiled = compiled
+        self.all_cpts = compiled.cpt_uris
+        self.shape = (len(compiled), len(compiled))
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        ancestors = compiled.ancestor_matrix().astype(bool).tocsr()
+        self._ancestors = ancestors
+        self._descendants = ancestors.T.tocsr()
+        cum_freqs = compiled.get_cumulative_freqs()
+        self._log_p = np.log(cum_freqs / cum_freqs[compiled.top_ind])
+
+    def _compute_row(self, i):
+        # Candidates for the least common subsumer: the ancestors of i other
+        # than the top concept. For every concept below one of them the lcs
+        # is the candidate with the smallest frequency.
+        start, end = self._ancestors.indptr[i:i + 2]
+        cands = self._ancestors.indices[start:end]
+        cands = cands[cands != self.compiled.top_ind]
+        desc = self._descendants[cands]
+        cols = desc.indices
+        lcs_log_p = np.zeros(self.shape[1])
+        np.minimum.at(lcs_log_p, cols,
+                      np.repeat(self._log_p[cands], np.diff(desc.indptr)))
+        cols = np.unique(cols)
+        den = self._log_p[i] + self._log_p[cols]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(den == 0, 1., 2 * lcs_log_p[cols] / den)
+        scores = np.clip(scores, 0., 1.)
+        scores[cols == i] = 1.
+        if i not in cols:
+            cols = np.append(cols, i)
+            scores = np.append(scores, 1.)
+            order = np.argsort(cols)
+            cols, scores = cols[order], scores[order]
+        nonzero = scores > 0
+        return cols[nonzero].astype(np.int32), scores[nonzero]
+
+    def row(self, i):
+        """
+        :param i: concept id
+        :return: (column indices, similarities) of the nonzero entries
+        """
+        with self._lock:
+            row = self._rows.get(i)
+            if row is not None:
+                self._rows.move_to_end(i)
+                self.hits += 1
+                return row
+        row = self._compute_row(i)
+        with self._lock:
+            self.misses += 1
+            self._rows[i] = row
+            while len(self._rows) > self.max_rows:
+                self._rows.popitem(last=False)
+        return row
+
+    def rows(self, inds):
+        """
+        :param inds: concept ids
+        :return: scipy.sparse.csr_matrix of shape (len(inds), n)
+        """
+        rows = [self.row(int(i)) for i in inds]
+        indptr = np.cumsum([0] + [len(r[0]) for r in rows])
+        indices = np.concatenate([r[0] for r in rows] + [np.zeros(0, np.int32)])
+        data = np.concatenate([r[1] for r in rows] + [np.zeros(0)])
+        return scipy.sparse.csr_matrix((data, indices, indptr),
+                                       shape=(len(rows), self.shape[1]))
+
+
+class QuantizedSimDict(RowSimDict):
+    """
+    Similarity matrix with values in [0, 1] stored with reduced precision.
+
+    The diagonal is not stored (it is 1), indices are int32 where possible
+    and the values are either float32/float16 or quantized to 8 or 16 bit
+    codes. Rows are decoded to float32 when they are needed, see `RowSimDict`.
+
+    :param sim_dict: scipy.sparse matrix or np.ndarray
+    :param dtype: 'float32', 'float16', 'uint16' or 'uint8'
+    """
+    dtypes = ('float32', 'float16', 'uint16', 'uint8')
+
+    def __init__(self, sim_dict, dtype='uint16'):
+        if dtype not in self.dtypes:
+            raise ValueError('dtype should be one of {}'.format(self.dtypes))
+        self.dtype = np.dtype(dtype)
+        sim_dict = scipy.sparse.coo_matrix(sim_dict)
+        self.shape = sim_dict.shape
+        off_diag = sim_dict.row != sim_dict.col
+        matrix = scipy.sparse.csr_matrix(
+            (sim_dict.data[off_diag], (sim_dict.row[off_diag],
+                                       sim_dict.col[off_diag])),
+            shape=self.shape
+        )
+        matrix.sum_duplicates()
+        if self.dtype.kind == 'u':
+            levels = np.iinfo(self.dtype).max
+            self.scale = np.float32(1. / levels)
+            matrix.data = np.rint(np.clip(matrix.data, 0, 1) * levels)
+        else:
+            self.scale = np.float32(1.)
+        matrix.eliminate_zeros()
+        index_dtype = np.int32 if matrix.nnz < np.iinfo(np.int32).max \
+            else np.int64
+        self.data = matrix.data.astype(self.dtype)
+        self.indices = matrix.indices.astype(index_dtype)
+        self.indptr = matrix.indptr.astype(index_dtype)
+
+    def to_arrays(self):
+        return {'data': self.data, 'indices': self.indices,
+                'indptr': self.indptr, 'shape': np.array(self.shape),
+                'scale': np.array(self.scale)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        :param arrays: dict from `to_arrays`, the arrays are not copied
+        """
+        sim_dict = cls.__new__(cls)
+        sim_dict.data = arrays['data']
+        sim_dict.indices = arrays['indices']
+        sim_dict.indptr = arrays['indptr']
+        sim_dict.shape = tuple(int(x) for x in arrays['shape'])
+        sim_dict.scale = np.float32(arrays['scale'])
+        sim_dict.dtype = sim_dict.data.dtype
+        return sim_dict
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.indices.nbytes + self.indptr.nbytes
+
+    def rows(self, inds):
+        """
+        :param inds: row indices
+        :return: float32 scipy.sparse.csr_matrix of shape (len(inds), n)
+        """
+        inds = np.asarray(inds, dtype=np.int64).ravel()
+        starts = self.indptr[inds]
+        lens = self.indptr[inds + 1] - starts
+        row_starts = np.cumsum(lens) - lens
+        pos = np.arange(lens.sum()) + np.repeat(starts - row_starts, lens)
+        indptr = np.r_[0, np.cumsum(lens)]
+        rows = scipy.sparse.csr_matrix(
+            (self.data[pos].astype(np.float32) * self.scale,
+             self.indices[pos], indptr),
+            shape=(len(inds), self.shape[1])
+        )
+        diag = scipy.sparse.csr_matrix(
+            (np.ones(len(inds), dtype=np.float32),
+             (np.arange(len(inds)), inds)),
+            shape=rows.shape
+        )
+        return rows + diag
@@ -0,0 +1,171 @@
+"""
+Local concept tagging with the labels of a thesaurus.
+
+`ConceptTagger` compiles the pref/alt/hidden labels into an Aho-Corasick
+automaton over normalized tokens and finds all label occurrences in a
+document in one pass. Its output feeds
+`SoftCosineCombinedSimilarity.transform_cpts` and `transform_terms`.
+"""
+import re
+import logging
+import unicodedata
+from itertools import islice
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """
+    Unicode (NFKC) and case normalization, then split into word tokens.
+
+    :param text: str
+    :return: list of tokens
+    """
+    return TOKEN_RE.findall(unicodedata.normalize('NFKC', text).casefold())
+
+
+class ConceptTagger:
+    """
+    :param uri2labels: {cpt_uri: [label, ...]}, e.g. from
+        `Thesaurus.get_all_concepts_and_labels`
+    :param longest_match: if True, overlapping occurrences are resolved
+        leftmost-longest first (as "new york city" should not also count as
+        "new york"); otherwise all occurrences are counted
+    """
+
+    def __init__(self, uri2labels, longest_match=True):
+        self.longest_match = longest_match
+        # terms[k] is the normalized label k, term_cpts[k] its concepts
+        self.terms = []
+        self.term_cpts = []
+        term_inds = dict()
+        for cpt_uri, labels in uri2labels.items():
+            for label in labels:
+                tokens = tuple(tokenize(label))
+                if not tokens:
+                    continue
+                if tokens not in term_inds:
+                    term_inds[tokens] = len(self.terms)
+                    self.terms.append(' '.join(tokens))
+                    self.term_cpts.append([])
+                cpts = self.term_cpts[term_inds[tokens]]
+                if str(cpt_uri) not in cpts:
+                    cpts.append(str(cpt_uri))
+        self.term_lens = [len(t.split(' ')) for t in self.terms]
+        self._build(term_inds)
+        logger.info('Tagger with {} terms, {} states'.format(
+            len(self.terms), len(self.goto)))
+
+    @classmethod
+    def from_thesaurus(cls, the, lang='en', **kwargs):
+        return cls(the.get_all_concepts_and_labels(lang=lang), **kwargs)
+
+    def _build(self, term_inds):
+        # Trie of the token sequences
+        self.goto = [dict()]
+        outputs = [[]]
+        for tokens, k in term_inds.items():
+            state = 0
+            for token in tokens:
+                nxt = self.goto[state].get(token)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][token] = nxt
+                    self.goto.append(dict())
+                    outputs.append([])
+                state = nxt
+            outputs[state].append(k)
+        # Failure links in breadth first order, outputs of the failure state
+        # are merged into the state
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and token not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(token, 0)
+                self.fail[nxt] = f if f != nxt else 0
+                outputs[nxt].extend(outputs[self.fail[nxt]])
+        self.outputs = [tuple(x) for x in outputs]
+
+    def find(self, text):
+        """
+        :param text: document
+        :return: list of (start token, term index) occurrences
+        """
+        goto, fail, outputs, lens = (self.goto, self.fail, self.outputs,
+                                     self.term_lens)
+        found = []
+        state = 0
+        for pos, token in enumerate(tokenize(text)):
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for k in outputs[state]:
+                found.append((pos - lens[k] + 1, k))
+        if self.longest_match and found:
+            found.sort(key=lambda x: (x[0], -lens[x[1]]))
+            selected = []
+            end = -1
+            for start, k in found:
+                if start > end:
+                    selected.append((start, k))
+                    end = start + lens[k] - 1
+            found = selected
+        return found
+
+    def tag(self, text):
+        """
+        :param text: document
+        :return: ({cpt_uri: freq}, Counter {term: freq})
+        """
+        term_freqs = Counter(k for _, k in self.find(text))
+        cpt_freqs = Counter()
+        for k, freq in term_freqs.items():
+            for cpt_uri in self.term_cpts[k]:
+                cpt_freqs[cpt_uri] += freq
+        return dict(cpt_freqs), Counter({self.terms[k]: freq
+                                         for k, freq in term_freqs.items()})
+
+    def tag_many(self, texts, n_jobs=1, chunksize=64):
+        """
+        Tag a stream of documents, in `n_jobs` processes if `n_jobs` > 1.
+        At most a few chunks of documents are in flight at any time.
+
+        :param texts: iterable of documents
+        :return: generator of `tag` results in the order of `texts`
+        """
+        if n_jobs == 1:
+            for text in texts:
+                yield self.tag(text)
+            return
+        texts = iter(texts)
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(self,)) as executor:
+            while True:
+                batch = list(islice(texts, 4 * n_jobs * chunksize))
+                if not batch:
+                    break
+                yield from executor.map(_tag_in_worker, batch,
+                                        chunksize=chunksize)
+
+
+_worker_tagger = None
+
+
+def _init_worker(tagger):
+    global _worker_tagger
+    _worker_tagger = tagger
+
+
+def _tag_in_worker(text):
+    return _worker_tagger.tag(text)
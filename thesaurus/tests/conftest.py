@@ -0,0 +1,41 @@
+import pytest
+
+from thesaurus.thesaurus import Thesaurus
+
+
+def small_thesaurus():
+    the = Thesaurus()
+    the.add_path([('http://x/a', 'A'), ('http://x/b', 'B'),
+                  ('http://x/c', 'C')])
+    the.add_path([('http://x/a', 'A'), ('http://x/d', 'D')])
+    the.add_path([('http://x/e', 'E')])
+    return the
+
+
+def lin_thesaurus():
+    the = Thesaurus()
+    the.add_path([('http://x/a', 'A'), ('http://x/b', 'B'),
+                  ('http://x/c', 'C')])
+    the.add_path([('http://x/a', 'A'), ('http://x/b', 'B'),
+                  ('http://x/f', 'F')])
+    the.add_path([('http://x/a', 'A'), ('http://x/d', 'D')])
+    the.add_path([('http://x/e', 'E'), ('http://x/g', 'G')])
+    the.precompute_number_children()
+    return the
+
+
+@pytest.fixture
+def make_small_thesaurus():
+    """
+    Builds a new thesaurus with the paths a-b-c, a-d and e.
+    """
+    return small_thesaurus
+
+
+@pytest.fixture
+def make_lin_thesaurus():
+    """
+    Builds a new thesaurus with the paths a-b-c, a-b-f, a-d and e-g and
+    precomputed numbers of children for the Lin similarity.
+    """
+    return lin_thesaurus
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import scipy.sparse
+
+from thesaurus.clustering import similar_pairs, threshold_clusters, k_medoids
+from thesaurus.compare_docs import SoftCosineCombinedSimilarity, \
+    soft_cosine_matrix
+from thesaurus.sim_dict import LazySimDict
+
+
+class TestClustering:
+    @pytest.fixture(autouse=True)
+    def set_up(self, make_lin_thesaurus):
+        self.compiled = make_lin_thesaurus().compile()
+        self.sim_dict = LazySimDict(self.compiled)
+        self.sim = SoftCosineCombinedSimilarity(
+            sim_dict=self.sim_dict, all_cpts=self.compiled.cpt_uris
+        )
+        rng = np.random.RandomState(0)
+        below_a = ['http://x/a', 'http://x/b', 'http://x/c', 'http://x/d',
+                   'http://x/f']
+        below_e = ['http://x/e', 'http://x/g']
+        self.docs = self.sim.transform_cpts_many(
+            [{c: rng.randint(1, 4) for c in rng.choice(below_a, 2, False)}
+             for _ in range(12)] +
+            [{c: rng.randint(1, 4) for c in rng.choice(below_e, 1)}
+             for _ in range(8)]
+        )
+        self.cosines = soft_cosine_matrix(self.docs, None, self.sim_dict)
+
+    def check_pairs(self, threshold, **kwargs):
+        rows, cols, scores = similar_pairs(self.docs, self.sim_dict,
+                                           threshold, **kwargs)
+        expected = np.triu(self.cosines >= threshold, 1)
+        assert set(zip(rows, cols)) == set(zip(*np.nonzero(expected)))
+        assert np.allclose(scores, self.cosines[rows, cols])
+
+    def test_similar_pairs(self):
+        for threshold in [1e-9, .5, .99]:
+            self.check_pairs(threshold, block_size=7, n_threads=3)
+        self.check_pairs(.5)
+        self.check_pairs(.5, block_size=1)
+
+    def test_threshold_clusters(self):
+        labels = threshold_clusters(self.docs, self.sim_dict, 1e-9)
+        assert len(set(labels[:12])) == 1
+        assert not set(labels[:12]) & set(labels[12:])
+        n_components, expected = scipy.sparse.csgraph.connected_components(
+            scipy.sparse.csr_matrix(self.cosines >= .9), directed=False
+        )
+        labels = threshold_clusters(self.docs, self.sim_dict, .9)
+        assert len(set(labels)) == n_components
+        assert (labels[:, None] == labels[None, :]).tolist() == \
+            (expected[:, None] == expected[None, :]).tolist()
+
+    def test_k_medoids(self):
+        medoids, labels = k_medoids(self.docs, self.sim_dict, 2,
+                                    random_state=0)
+        assert len(set(labels[:12])) == 1 and len(set(labels[12:])) == 1
+        assert labels[0] != labels[12]
+        assert (labels[medoids] == [0, 1]).all()
+        blocked = k_medoids(self.docs, self.sim_dict, 2, random_state=0,
+                            block_size=3)
+        assert (blocked[0] == medoids).all()
+        assert (blocked[1] == labels).all()
@@ -0,0 +1,115 @@
+import tracemalloc
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from thesaurus.compare_docs import SoftCosineCombinedSimilarity, soft_cosine, \
+    soft_cosine_matrix, weighted_jaccard_matrix, TermVocabulary
+from thesaurus.sim_dict import LazySimDict
+
+
+DOCS = [{'http://x/c': 2, 'http://x/g': 1},
+        {'http://x/f': 1, 'http://x/d': 3},
+        {'http://x/e': 1},
+        {}]
+
+
+class TestSoftCosineMatrix:
+    @pytest.fixture(autouse=True)
+    def set_up(self, make_lin_thesaurus):
+        self.compiled = make_lin_thesaurus().compile()
+        self.sim = SoftCosineCombinedSimilarity(
+            sim_dict=LazySimDict(self.compiled).toarray(),
+            all_cpts=self.compiled.cpt_uris
+        )
+        self.docs = self.sim.transform_cpts_many(DOCS)
+
+    def test_transform_cpts_many(self):
+        for i, doc in enumerate(DOCS):
+            assert (self.docs[i] != self.sim.transform_cpts(doc)).nnz == 0
+
+    def test_pairwise(self):
+        sims = self.sim.compute_cpts_many(self.docs)
+        for i in range(len(DOCS)):
+            for j in range(len(DOCS)):
+                assert np.isclose(sims[i, j], soft_cosine(
+                    self.docs[i], self.docs[j], self.sim.sim_dict
+                ))
+
+    def test_lazy(self):
+        lazy = LazySimDict(self.compiled)
+        assert np.allclose(soft_cosine_matrix(self.docs, None, lazy),
+                           self.sim.compute_cpts_many(self.docs))
+
+    def test_expansion(self):
+        expanded = self.sim.expand_cpts(self.docs, self.compiled, decay=0.5)
+        row = dict(zip(self.compiled.cpt_uris, expanded[0].toarray().ravel()))
+        assert row['http://x/c'] == 2
+        assert row['http://x/b'] == 1
+        assert row['http://x/a'] == .5
+        assert row['http://x/e'] == .5
+        assert row[':T'] == 0
+        cosines = soft_cosine_matrix(expanded)
+        assert cosines[0, 1] > soft_cosine_matrix(self.docs)[0, 1]
+        assert np.allclose(np.diag(cosines)[:3], 1)
+
+
+TERMS = [{'a': 2, 'b': 1}, {'b': 3, 'c': 1, 'd': 0}, {'a': 1, 'e': -2},
+         {}, {'c': 1.5, 'e': 2}]
+
+
+class TestWeightedJaccard:
+    @pytest.fixture(autouse=True)
+    def set_up(self, make_lin_thesaurus):
+        compiled = make_lin_thesaurus().compile()
+        self.sim = SoftCosineCombinedSimilarity(
+            sim_dict=LazySimDict(compiled).toarray(),
+            all_cpts=compiled.cpt_uris
+        )
+
+    def counter_similarity(self, t1, t2):
+        cpt_vect = self.sim.transform_cpts({})
+        return self.sim.compute((cpt_vect, Counter(t1)),
+                                (cpt_vect, Counter(t2)))[1]
+
+    def test_same_as_counters(self):
+        vects = self.sim.transform_term_vectors(TERMS)
+        sims = self.sim.compute_terms_many(vects)
+        cpt_vect = self.sim.transform_cpts({})
+        for i, t1 in enumerate(TERMS):
+            for j, t2 in enumerate(TERMS):
+                expected = self.counter_similarity(t1, t2)
+                assert sims[i, j] == expected
+                assert self.sim.compute((cpt_vect, vects[i]),
+                                        (cpt_vect, vects[j]))[1] == expected
+
+    def test_growing_vocabulary(self):
+        vocabulary = TermVocabulary()
+        corpus = vocabulary.transform_many(TERMS[:2])
+        query = vocabulary.transform({'x': 1, 'b': 2})
+        assert corpus.shape[1] < query.shape[1]
+        sims = self.sim.compute_terms_many(query, corpus)
+        assert sims.tolist() == [[
+            self.counter_similarity({'x': 1, 'b': 2}, t) for t in TERMS[:2]
+        ]]
+
+    def test_blocks(self):
+        rng = np.random.RandomState(0)
+        corpus = TermVocabulary().transform_many(
+            [{int(t): int(c) for t, c in zip(rng.zipf(1.5, 30),
+                                               rng.randint(1, 4, 30))}
+             for _ in range(4000)]
+        )
+        queries = corpus[:200]
+        tracemalloc.start()
+        sims = weighted_jaccard_matrix(queries, corpus)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        # Frequent terms pair every query entry with most of the corpus
+        assert peak < 4 * sims.nbytes
+        assert np.allclose(
+            sims, weighted_jaccard_matrix(queries, corpus, block_size=200)
+        )
+        assert np.allclose(sims[:3, :3],
+                           weighted_jaccard_matrix(queries[:3], block_size=1))
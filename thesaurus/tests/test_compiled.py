@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from thesaurus.compiled import CompiledThesaurus, get_compiled
+
+
+class TestCompiledThesaurus:
+    @pytest.fixture(autouse=True)
+    def set_up(self, make_small_thesaurus):
+        self.the = make_small_thesaurus()
+        self.compiled = self.the.compile()
+
+    def test_concepts(self):
+        assert set(self.compiled.cpt_uris) == \
+            {str(x) for x in self.the.get_all_concepts()}
+        assert list(self.compiled.cpt_uris) == sorted(self.compiled.cpt_uris)
+        assert self.compiled.cpt_uris[self.compiled.top_ind] == ':T'
+
+    def test_tree(self):
+        parent, depth = self.compiled.tree()
+        c = self.compiled.index('http://x/c')
+        assert depth[c] == 3
+        assert self.compiled.cpt_uris[parent[c]] == 'http://x/b'
+
+    def test_layout(self):
+        pos = self.compiled.layout()
+        _, depth = self.compiled.tree()
+        assert pos.shape == (len(self.compiled), 2)
+        assert np.allclose(np.linalg.norm(pos, axis=1), depth)
+
+    def test_level_of_detail(self):
+        representative, max_depth = self.compiled.level_of_detail(4)
+        assert max_depth == 1
+        c = self.compiled.index('http://x/c')
+        assert self.compiled.cpt_uris[representative[c]] == 'http://x/a'
+
+    def test_snapshot(self, tmp_path):
+        path = str(tmp_path / 'the.npz')
+        compiled = get_compiled(path, self.the, with_layout=True)
+        loaded = CompiledThesaurus.load(path)
+        assert loaded.version == compiled.version
+        assert np.allclose(loaded._layout, compiled.layout())
+
+    def test_ancestor_matrix(self):
+        ancestors = self.compiled.ancestor_matrix()
+        c = self.compiled.index('http://x/c')
+        row = ancestors[c].toarray().ravel()
+        assert {self.compiled.cpt_uris[j]: row[j]
+                for j in np.flatnonzero(row)} == \
+            {'http://x/c': 1, 'http://x/b': 2, 'http://x/a': 3, ':T': 4}
+
+    def test_add_frequencies_bulk(self):
+        self.the.add_frequencies_bulk([(['http://x/c', 'http://x/d'],
+                                        [3., 2.])])
+        compiled = self.the.compile()
+        freqs = dict(zip(compiled.cpt_uris, compiled.get_cumulative_freqs(0)))
+        assert freqs == {':T': 5, 'http://x/a': 5, 'http://x/b': 3,
+                         'http://x/c': 3, 'http://x/d': 2, 'http://x/e': 0}
@@ -0,0 +1,66 @@
+import os
+from mmap import mmap
+import tempfile
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from thesaurus.compare_docs import soft_cosine_matrix
+from thesaurus.corpus import CorpusScorer, ShardedCorpus, save_shards
+from thesaurus.sim_dict import LazySimDict
+
+
+class TestCorpusScorer:
+    @pytest.fixture(autouse=True)
+    def set_up(self, make_lin_thesaurus):
+        compiled = make_lin_thesaurus().compile()
+        self.sim_dict = LazySimDict(compiled).toarray()
+        rng = np.random.RandomState(0)
+        self.docs = scipy.sparse.random(
+            23, len(compiled), density=.3, format='csr', random_state=rng
+        )
+        self.docs[5] = self.docs[2]
+        self.tmp = tempfile.TemporaryDirectory()
+        self.corpus = save_shards(self.docs, self.tmp.name, shard_size=7)
+        self.expected = soft_cosine_matrix(self.docs, None, self.sim_dict)
+
+    def teardown_method(self):
+        self.tmp.cleanup()
+
+    def test_shards(self):
+        corpus = ShardedCorpus(self.tmp.name)
+        assert len(corpus.shard_dirs) == 4
+        assert corpus.shape == self.docs.shape
+        base = corpus.load_shard(1).data
+        while base is not None and not isinstance(base, (np.memmap, mmap)):
+            base = base.base
+        assert base is not None
+        chunks = list(corpus.iter_chunks(5))
+        assert [offset for offset, _ in chunks] == [0, 5, 7, 12, 14, 19, 21]
+        stacked = scipy.sparse.vstack([c for _, c in chunks])
+        assert (stacked != self.docs).nnz == 0
+
+    def test_search(self):
+        progress = []
+        scorer = CorpusScorer(self.sim_dict, self.corpus, chunk_size=4,
+                              n_threads=3,
+                              progress=lambda *x: progress.append(x))
+        results = scorer.search(self.docs[:6], top_k=3, query_chunk_size=4)
+        assert progress == [(4, 6), (6, 6)]
+        for query_id, ids, scores in results:
+            expected = np.sort(self.expected[query_id])[::-1][:3]
+            assert np.allclose(scores, expected)
+            assert np.allclose(self.expected[query_id, ids], scores)
+
+    def test_deduplicate(self):
+        scorer = CorpusScorer(self.sim_dict, self.corpus, chunk_size=6)
+        out_path = os.path.join(self.tmp.name, 'dups.tsv')
+        scorer.deduplicate(.999, out_path=out_path, query_chunk_size=10)
+        with open(out_path) as f:
+            pairs = {tuple(line.split('\t')[:2]) for line in f}
+        sims = self.expected.copy()
+        np.fill_diagonal(sims, 0)
+        expected = {(str(i), str(j)) for i, j in zip(*np.nonzero(sims > .999))}
+        assert ('2', '5') in expected
+        assert pairs == expected
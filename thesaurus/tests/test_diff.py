@@ -0,0 +1,41 @@
+import pytest
+import rdflib
+from rdflib.namespace import SKOS
+
+
+def uri(x):
+    return rdflib.URIRef('http://x/' + x)
+
+
+class TestDiff:
+    @pytest.fixture(autouse=True)
+    def set_up(self, make_small_thesaurus):
+        self.old = make_small_thesaurus()
+        self.new = make_small_thesaurus()
+        # b moves from a to e, d is relabeled, f is added
+        self.new.remove((uri('b'), SKOS.broader, uri('a')))
+        self.new.add((uri('b'), SKOS.broader, uri('e')))
+        self.new.set((uri('d'), SKOS.prefLabel,
+                      rdflib.Literal('DD', lang='en')))
+        self.new.add_path([('http://x/e', 'E'), ('http://x/f', 'F')])
+        self.new.add((uri('f'), self.new.cum_freq_predicate,
+                      rdflib.Literal(3.)))
+        self.new.add((uri('c'), self.new.cum_freq_predicate,
+                      rdflib.Literal(2.)))
+
+    def test_same(self, make_small_thesaurus):
+        assert not self.old.diff(make_small_thesaurus())
+
+    def test_diff(self):
+        diff = self.old.diff(self.new)
+        assert list(diff.added) == ['http://x/f']
+        assert list(diff.removed) == []
+        assert list(diff.moved) == ['http://x/b']
+        assert list(diff.relabeled) == ['http://x/d']
+        assert list(diff.closure_changed) == ['http://x/b', 'http://x/c']
+        assert list(diff.freq_changed) == ['http://x/c']
+
+    def test_reverse(self):
+        diff = self.new.diff(self.old.compile())
+        assert list(diff.removed) == ['http://x/f']
+        assert list(diff.moved) == ['http://x/b']
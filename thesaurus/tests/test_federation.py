@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+import rdflib
+from rdflib.namespace import SKOS
+
+from thesaurus.compare_docs import SoftCosineCombinedSimilarity
+from thesaurus.federation import FederatedThesaurus
+from thesaurus.sim_dict import LazySimDict
+from thesaurus.thesaurus import Thesaurus
+
+
+def make_other():
+    the = Thesaurus()
+    the.add_path([('http://y/a', 'A'), ('http://y/b', 'B')])
+    the.add_path([('http://y/c', 'C')])
+    the.add((rdflib.URIRef('http://y/b'), SKOS.exactMatch,
+             rdflib.URIRef('http://x/b')))
+    the.precompute_number_children()
+    return the
+
+
+class TestFederatedThesaurus:
+    @pytest.fixture(autouse=True)
+    def set_up(self, make_lin_thesaurus):
+        self.first = make_lin_thesaurus().compile()
+        self.second = make_other()
+        self.fed = FederatedThesaurus()
+        self.fed.add('x', self.first)
+        self.fed.add('y', self.second)
+
+    def test_ids(self):
+        n = len(self.first)
+        assert len(self.fed) == n + len(self.second.compile())
+        assert self.fed.index('x:T') == self.first.top_ind
+        assert self.fed.project_of(self.fed.index('y:T')) == \
+            ('y', self.second.compile().top_ind)
+        assert self.fed.index('http://x/c') == self.first.index('http://x/c')
+
+    def test_block_diagonal(self):
+        sims = self.fed.sim_dict.toarray()
+        n = len(self.first)
+        assert np.allclose(sims[:n, :n], LazySimDict(self.first).toarray())
+        assert np.allclose(sims[n:, n:],
+                           LazySimDict(self.second.compile()).toarray())
+        xb, yb = self.fed.index('http://x/b'), self.fed.index('http://y/b')
+        assert sims[xb, yb] == sims[yb, xb] == 1
+        sims[xb, yb] = sims[yb, xb] = 0
+        assert not sims[:n, n:].any() and not sims[n:, :n].any()
+
+    def test_soft_cosine(self):
+        sim = SoftCosineCombinedSimilarity(sim_dict=self.fed.sim_dict,
+                                           all_cpts=self.fed.cpt_uris)
+        docs = sim.transform_cpts_many([{'http://x/b': 1}, {'http://y/b': 1},
+                                        {'http://y/c': 1}])
+        cosines = sim.compute_cpts_many(docs)
+        assert np.isclose(cosines[0, 1], 1)
+        assert cosines[0, 2] == 0
+
+    def test_add_keeps_blocks(self):
+        sim_dict = self.fed.sim_dict
+        sim_dict[[0, 1]]
+        self.fed.add('z', make_other().compile())
+        assert self.fed.sim_dict is not sim_dict
+        assert self.fed.sim_dict.blocks[0] is sim_dict.blocks[0]
+        assert self.fed.sim_dict.blocks[0].hits == 0
+        self.fed.sim_dict[[0, 1]]
+        assert self.fed.sim_dict.blocks[0].hits == 2
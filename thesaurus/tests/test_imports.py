@@ -0,0 +1,47 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+# Seconds the scoring side may take on top of importing numpy and scipy
+IMPORT_BUDGET = 0.3
+
+
+def import_in_subprocess(modules):
+    code = (
+        'import sys, time, json\n'
+        't = time.perf_counter()\n'
+        'import {}\n'
+        'print(json.dumps([time.perf_counter() - t, sorted(sys.modules)]))'
+    ).format(modules)
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    return json.loads(out.stdout)
+
+
+class TestImports:
+    def test_scoring_imports(self):
+        _, modules = import_in_subprocess('thesaurus.compare_docs')
+        for heavy in ['rdflib', 'pp_api', 'requests', 'thesaurus.thesaurus']:
+            assert heavy not in modules
+
+    def test_scoring_import_time(self):
+        reference = min(
+            import_in_subprocess('numpy, scipy.sparse, scipy.sparse.csgraph')[0]
+            for _ in range(3)
+        )
+        elapsed = min(import_in_subprocess('thesaurus.compare_docs')[0]
+                      for _ in range(3))
+        assert elapsed < reference + IMPORT_BUDGET
+
+    def test_thesaurus_imports(self):
+        pytest.importorskip('rdflib')
+        _, modules = import_in_subprocess('thesaurus.thesaurus')
+        assert 'pp_api' not in modules
+        assert 'requests' not in modules
@@ -0,0 +1,139 @@
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import rdflib
+
+from thesaurus.loading import PoolPartyLoader
+from thesaurus.thesaurus import Thesaurus
+
+
+EXPORT = b"""
+@prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+<http://x/scheme> a skos:ConceptScheme .
+<http://x/{pid}/a> a skos:Concept ;
+    skos:prefLabel "A"@en ;
+    skos:topConceptOf <http://x/scheme> .
+<http://x/{pid}/b> a skos:Concept ;
+    skos:prefLabel "B"@en ;
+    skos:broader <http://x/{pid}/a> .
+"""
+
+FREQS = (b's,label,freq,cpt\r\n'
+         b'http://x/o1,"B, with comma",3,http://x/p1/b\r\n'
+         b'http://x/o2,A,2,http://x/p1/a\r\n')
+
+PAGES = [b'cpt,frequency\r\nhttp://x/p1/a,2\r\n',
+         b'cpt,frequency\r\nhttp://x/p1/b,3\r\n',
+         b'cpt,frequency\r\n']
+ALL_PAGES = b'cpt,frequency\r\nhttp://x/p1/a,2\r\nhttp://x/p1/b,3\r\n'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    failures = dict()
+    queries = set()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type):
+        # Every path fails once to exercise the retries
+        if not self.failures.setdefault(self.path, False):
+            self.failures[self.path] = True
+            self.send_response(503)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        pid = url.path.split('/')[-2]
+        assert parse_qs(url.query)['format'] == ['N3']
+        self.reply(EXPORT.replace(b'{pid}', pid.encode()), 'text/n3')
+
+    def do_POST(self):
+        body = parse_qs(self.rfile.read(int(self.headers['Content-Length'])))
+        query = body[b'query'][0].decode()
+        self.queries.add(query)
+        if 'group by' not in query:
+            self.reply(FREQS, 'text/csv')
+        elif 'limit 1\n' not in query:
+            self.reply(ALL_PAGES, 'text/csv')
+        elif 'filter' not in query:
+            self.reply(PAGES[0], 'text/csv')
+        elif 'http://x/p1/a' in query:
+            self.reply(PAGES[1], 'text/csv')
+        else:
+            self.reply(PAGES[2], 'text/csv')
+
+
+class TestPoolPartyLoader:
+    def setup_method(self):
+        StubHandler.failures = dict()
+        StubHandler.queries = set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.loader = PoolPartyLoader(server=self.url, backoff_factor=0.01)
+
+    def teardown_method(self):
+        self.loader.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_cpt_freqs(self):
+        freqs = self.loader.query_cpt_freqs(self.url + '/sparql', 'graph')
+        assert freqs[rdflib.URIRef('http://x/p1/b')] == {
+            'frequency': 3., 'mainLabel': 'B, with comma'
+        }
+
+    def test_iter_cpt_freqs(self):
+        batches = list(self.loader.iter_cpt_freqs(self.url + '/sparql',
+                                                  'graph', page_size=1))
+        assert [b[0] for b in batches] == [['http://x/p1/a'],
+                                           ['http://x/p1/b']]
+        assert [b[1].tolist() for b in batches] == [[2.], [3.]]
+
+    def test_prefetch(self):
+        export, pages = self.loader.submit_project(
+            'p1', self.url + '/sparql', 'graph', page_size=1
+        )
+        export.result()
+        assert next(pages)[0] == ['http://x/p1/a']
+        time.sleep(0.2)
+        # the first page and the prefetched second one
+        assert len(StubHandler.queries) == 2
+        assert [b[0] for b in pages] == [['http://x/p1/b']]
+        assert len(StubHandler.queries) == 3
+
+    def test_load_project(self):
+        the = self.loader.load_project('p1', self.url + '/sparql', 'graph')
+        a = rdflib.URIRef('http://x/p1/a')
+        b = rdflib.URIRef('http://x/p1/b')
+        assert the.top_uri in the.broaders(b)
+        assert the.get_own_freq(b) == 3
+        assert the.get_cumulative_freq(a) == 5
+        assert the.get_cumulative_freq(the.top_uri) == 5
+
+    def test_compile_once(self, monkeypatch):
+        calls = []
+        compile_ = Thesaurus.compile
+
+        def counting_compile(the, *args, **kwargs):
+            calls.append(the)
+            return compile_(the, *args, **kwargs)
+
+        monkeypatch.setattr(Thesaurus, 'compile', counting_compile)
+        the = self.loader.load_project('p1', self.url + '/sparql', 'graph')
+        assert len(calls) == 1
+        assert the.get_cumulative_freq(the.top_uri) == 5
+
+    def test_load_projects(self):
+        thes = self.loader.load_projects(['p1', 'p2'])
+        assert set(thes) == {'p1', 'p2'}
+        assert rdflib.URIRef('http://x/p2/a') in thes['p2'].get_all_concepts()
@@ -0,0 +1,44 @@
+import sys
+import types
+
+from thesaurus.plotting import plot_taxonomy_coverage
+
+
+def fake_plotly(monkeypatch):
+    # plot_taxonomy_coverage is written against the plotly 2 API, the fake
+    # returns the figure instead of rendering it
+    go = types.SimpleNamespace(Scatter=dict, Layout=dict, XAxis=dict,
+                               YAxis=dict, Data=list)
+    po = types.SimpleNamespace(plot=lambda fig, **kwargs: fig)
+    plotly = types.ModuleType('plotly')
+    plotly.offline, plotly.graph_objs = po, go
+    monkeypatch.setitem(sys.modules, 'plotly', plotly)
+    monkeypatch.setitem(sys.modules, 'plotly.offline', po)
+    monkeypatch.setitem(sys.modules, 'plotly.graph_objs', go)
+
+
+class TestPlotTaxonomyCoverage:
+    def test_plot(self, make_small_thesaurus, monkeypatch):
+        fake_plotly(monkeypatch)
+        the = make_small_thesaurus()
+        the.add_frequencies_bulk([(['http://x/c'], [3])])
+        lines, dots = plot_taxonomy_coverage(the)['data']
+        assert len(dots['x']) == len(the.get_all_concepts())
+        # 5 edges, 3 points per edge
+        assert len(lines['x']) == 15
+        info = dict(zip(dots['text'], dots['marker']['color']))
+        assert info['http://x/c, own frequency: 3, children frequency: 0'] == 'blue'
+        assert info['http://x/a, own frequency: 0, children frequency: 3'] == 'orange'
+
+    def test_snapshot_follows_changes(self, make_small_thesaurus, monkeypatch,
+                                      tmp_path):
+        fake_plotly(monkeypatch)
+        path = str(tmp_path / 'the.npz')
+        the = make_small_thesaurus()
+        _, dots = plot_taxonomy_coverage(the, snapshot_path=path)['data']
+        n_before = len(dots['x'])
+        the.add_path([('http://x/e', 'E'), ('http://x/f', 'F')])
+        the.add_frequencies_bulk([(['http://x/f'], [2])])
+        _, dots = plot_taxonomy_coverage(the, snapshot_path=path)['data']
+        assert len(dots['x']) == n_before + 1
+        assert 'http://x/f, own frequency: 2, children frequency: 0' in dots['text']
@@ -0,0 +1,139 @@
+import os
+import sys
+import subprocess
+import multiprocessing
+
+import numpy as np
+from scipy import sparse
+
+from thesaurus.compare_docs import SoftCosineCombinedSimilarity
+from thesaurus.shared import SharedArrays
+from thesaurus.compiled import CompiledThesaurus
+
+
+SIM = np.array([[1., .5, 0.],
+                [.5, 1., .2],
+                [0., .2, 1.]])
+CPTS = ['http://x/a', 'http://x/b', 'http://x/c']
+DOCS = [{'http://x/a': 2, 'http://x/c': 1}, {'http://x/b': 1}]
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+# Attach in the owner, in forked and spawned workers and in an unrelated
+# process; the resource trackers print to stderr if a registration is off
+ATTACH_SCRIPT = '''
+import sys, subprocess, multiprocessing
+import numpy as np
+from thesaurus.shared import SharedArrays
+
+if __name__ == '__main__':
+    shared = SharedArrays.create({'a': np.arange(5)})
+    SharedArrays.attach(shared.handle).close()
+    for method in ['fork', 'spawn']:
+        worker = multiprocessing.get_context(method).Process(
+            target=SharedArrays.attach, args=(shared.handle,))
+        worker.start()
+        worker.join()
+    subprocess.run([sys.executable, '-c',
+                    'from thesaurus.shared import SharedArrays; '
+                    'SharedArrays.attach({!r})'.format(shared.handle)],
+                   check=True)
+    attached = SharedArrays.attach(shared.handle)
+    assert attached['a'].sum() == 10
+    attached.close()
+    shared.close()
+'''
+
+
+def score_in_worker(handle, queue):
+    sim = SoftCosineCombinedSimilarity.from_shared(handle)
+    v1, v2 = [sim.transform_cpts(d) for d in DOCS]
+    queue.put(sim.compute_cpts(v1, v2))
+
+
+class TestShared:
+    def setup_method(self):
+        self.sim = SoftCosineCombinedSimilarity(
+            sim_dict=sparse.coo_matrix(SIM), all_cpts=CPTS
+        )
+        self.expected = self.sim.compute_cpts(
+            *[self.sim.transform_cpts(d) for d in DOCS]
+        )
+
+    def test_shared_arrays(self):
+        shared = SharedArrays.create({'a': np.arange(5), 'b': np.array(['x'])})
+        attached = SharedArrays.attach(shared.handle)
+        assert attached['a'].tolist() == [0, 1, 2, 3, 4]
+        assert not attached['a'].flags.writeable
+        attached.close()
+        shared.close()
+
+    def test_resource_tracker(self):
+        out = subprocess.run([sys.executable, '-c', ATTACH_SCRIPT], cwd=ROOT,
+                             stderr=subprocess.PIPE, universal_newlines=True,
+                             timeout=60)
+        assert out.returncode == 0, out.stderr
+        assert out.stderr == ''
+
+    def test_shared_similarity(self):
+        sim = SoftCosineCombinedSimilarity(sim_dict=sparse.coo_matrix(SIM),
+                                           all_cpts=CPTS, shared=True)
+        assert sim.cpt_inds['http://x/c'] == 2
+        assert np.isclose(
+            sim.compute_cpts(*[sim.transform_cpts(d) for d in DOCS]),
+            self.expected
+        )
+        sim.shared.close()
+
+    def test_expand_attached(self, make_small_thesaurus):
+        compiled = make_small_thesaurus().compile()
+        sim = SoftCosineCombinedSimilarity(
+            sim_dict=sparse.identity(len(compiled)),
+            all_cpts=compiled.cpt_uris, shared=True
+        )
+        attached = SoftCosineCombinedSimilarity.from_shared(sim.shared.handle)
+        docs = attached.transform_cpts_many([{'http://x/c': 1}])
+        assert (attached.expand_cpts(docs, compiled) !=
+                sim.expand_cpts(docs, compiled)).nnz == 0
+        attached.shared.close()
+        sim.shared.close()
+
+    def test_shared_quantized(self):
+        sim = SoftCosineCombinedSimilarity(sim_dict=SIM, all_cpts=CPTS,
+                                           sim_dtype='uint8', shared=True)
+        attached = SoftCosineCombinedSimilarity.from_shared(sim.shared.handle)
+        assert attached.sim_dict.data.dtype == np.uint8
+        assert not attached.sim_dict.data.flags.writeable
+        assert np.isclose(
+            attached.compute_cpts(*[attached.transform_cpts(d) for d in DOCS]),
+            self.expected, atol=1e-2
+        )
+        attached.shared.close()
+        sim.shared.close()
+
+    def test_worker(self):
+        shared = self.sim.share()
+        ctx = multiprocessing.get_context('spawn')
+        queue = ctx.Queue()
+        worker = ctx.Process(target=score_in_worker,
+                             args=(shared.handle, queue))
+        worker.start()
+        result = queue.get(timeout=60)
+        worker.join()
+        assert np.isclose(result, self.expected)
+        shared.close()
+
+    def test_shared_compiled(self, make_small_thesaurus):
+        compiled = make_small_thesaurus().compile()
+        shared = compiled.share()
+        attached = CompiledThesaurus.from_shared(shared.handle)
+        assert attached.version == compiled.version
+        assert attached.index('http://x/d') == compiled.index('http://x/d')
+        ancestors = attached.ancestor_matrix()
+        assert not ancestors.data.flags.writeable
+        assert (ancestors != compiled.ancestor_matrix()).nnz == 0
+        assert compiled.shared is None
+        attached.shared.close()
+        shared.close()
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+import rdflib
+from scipy import sparse
+
+from thesaurus.sim_dict import LazySimDict, QuantizedSimDict
+from thesaurus.compare_docs import SoftCosineCombinedSimilarity, \
+    soft_cosine, quantization_report
+
+
+class TestLazySimDict:
+    @pytest.fixture(autouse=True)
+    def set_up(self, make_lin_thesaurus):
+        self.the = make_lin_thesaurus()
+        self.compiled = self.the.compile()
+        self.sim_dict = LazySimDict(self.compiled, max_rows=3)
+
+    def test_lin_similarity(self):
+        sims = self.sim_dict.toarray()
+        for i, c1 in enumerate(self.compiled.cpt_uris):
+            for j, c2 in enumerate(self.compiled.cpt_uris):
+                expected = self.the.get_lin_similarity(rdflib.URIRef(c1),
+                                                       rdflib.URIRef(c2))
+                assert np.isclose(sims[i, j], expected), (c1, c2)
+
+    def test_cache(self):
+        self.sim_dict[[0, 1, 2, 3]]
+        assert len(self.sim_dict._rows) == 3
+        self.sim_dict[3]
+        assert self.sim_dict.hits == 1
+
+    def test_soft_cosine(self):
+        lazy = SoftCosineCombinedSimilarity(the=self.compiled, lazy=True)
+        full = SoftCosineCombinedSimilarity(
+            sim_dict=self.sim_dict.toarray(), all_cpts=self.compiled.cpt_uris
+        )
+        docs = [{'http://x/c': 2, 'http://x/g': 1},
+                {'http://x/f': 1, 'http://x/d': 3}]
+        assert np.isclose(
+            lazy.compute_cpts(*[lazy.transform_cpts(d) for d in docs]),
+            full.compute_cpts(*[full.transform_cpts(d) for d in docs])
+        )
+
+    def test_not_shared(self):
+        with pytest.raises(ValueError):
+            SoftCosineCombinedSimilarity(the=self.compiled, lazy=True,
+                                         shared=True)
+
+
+class TestQuantizedSimDict:
+    def setup_method(self):
+        rng = np.random.RandomState(0)
+        sims = rng.rand(30, 30) * (rng.rand(30, 30) < .2)
+        sims = np.maximum(sims, sims.T)
+        np.fill_diagonal(sims, 1)
+        self.sims = sims
+        self.docs = sparse.random(10, 30, density=.2, format='csr',
+                                  random_state=rng)
+
+    def test_rows(self):
+        for dtype, tol in [('float32', 1e-6), ('float16', 1e-3),
+                           ('uint16', .5 / 65535 + 1e-7),
+                           ('uint8', .5 / 255 + 1e-7)]:
+            quantized = QuantizedSimDict(self.sims, dtype=dtype)
+            assert np.abs(quantized.toarray() - self.sims).max() <= tol
+            assert quantized.indices.dtype == np.int32
+
+    def test_report(self):
+        quantized = QuantizedSimDict(self.sims, dtype='uint8')
+        report = quantization_report(self.sims, quantized, self.docs)
+        assert report['max_abs_error'] <= .5 / 255 + 1e-7
+        assert report['max_soft_cosine_error'] < 1e-2
+        assert report['quantized_nbytes'] < report['nbytes'] / 2
+
+    def test_soft_cosine(self):
+        sim = SoftCosineCombinedSimilarity(
+            sim_dict=self.sims, all_cpts=[str(i) for i in range(30)],
+            sim_dtype='uint16'
+        )
+        exact = soft_cosine(self.docs[0], self.docs[1],
+                            sparse.csr_matrix(self.sims))
+        assert np.isclose(sim.compute_cpts(self.docs[0], self.docs[1]), exact,
+                          atol=1e-4)
@@ -0,0 +1,39 @@
+from collections import Counter
+
+from thesaurus.tagging import ConceptTagger
+
+
+URI2LABELS = {
+    'http://x/ny': ['New York'],
+    'http://x/nyc': ['New York City', 'NYC'],
+    'http://x/city': ['city'],
+    'http://x/cafe': ['Café'],
+    'http://x/he': ['he', 'she'],
+    'http://x/hers': ['hers'],
+}
+
+
+class TestConceptTagger:
+    def setup_method(self):
+        self.tagger = ConceptTagger(URI2LABELS)
+
+    def test_longest_match(self):
+        cpts, terms = self.tagger.tag('I love New York city! new york.')
+        assert cpts == {'http://x/nyc': 1, 'http://x/ny': 1}
+        assert terms == Counter({'new york city': 1, 'new york': 1})
+
+    def test_all_matches(self):
+        tagger = ConceptTagger(URI2LABELS, longest_match=False)
+        cpts, _ = tagger.tag('New York City')
+        assert cpts == {'http://x/nyc': 1, 'http://x/ny': 1, 'http://x/city': 1}
+
+    def test_normalization(self):
+        cpts, _ = self.tagger.tag('CAFÉ, café and ushers')
+        assert cpts == {'http://x/cafe': 2}
+
+    def test_tag_many(self):
+        docs = ['she said NYC', 'hers', 'nothing'] * 10
+        expected = [self.tagger.tag(d) for d in docs]
+        assert list(self.tagger.tag_many(docs)) == expected
+        assert list(self.tagger.tag_many(docs, n_jobs=2, chunksize=4)) == \
+            expected
@@ -0,0 +1,64 @@
+import pytest
+import rdflib
+from rdflib.namespace import SKOS
+
+from thesaurus.compiled import CompiledThesaurus
+from thesaurus.validation import validate_hierarchy
+
+
+def uri(x):
+    return rdflib.URIRef('http://x/' + x)
+
+
+class TestValidation:
+    @pytest.fixture(autouse=True)
+    def set_up(self, make_small_thesaurus):
+        self.the = make_small_thesaurus()
+        # a is below c: a, b, c is a cycle
+        self.the.add((uri('a'), SKOS.broader, uri('c')))
+        self.the.add((uri('c'), SKOS.narrower, uri('a')))
+        # e below d without the narrower link, f only as narrower of e
+        self.the.add((uri('e'), SKOS.broader, uri('d')))
+        self.the.add((uri('e'), SKOS.narrower, uri('f')))
+        self.the.add((uri('f'), SKOS.prefLabel, rdflib.Literal('F', lang='en')))
+        # g and h below each other, not attached to the top, without labels
+        for x, y in [('g', 'h'), ('h', 'g')]:
+            self.the.add((uri(x), SKOS.broader, uri(y)))
+            self.the.add((uri(y), SKOS.narrower, uri(x)))
+        for x in 'fgh':
+            self.the.add((uri(x), rdflib.RDF.type, SKOS.Concept))
+
+    def test_valid(self, make_small_thesaurus):
+        report = make_small_thesaurus().validate()
+        assert report.is_dag
+
+    def test_report(self):
+        report = self.the.validate()
+        assert not report.is_dag
+        assert sorted(sorted(x) for x in report.cycles) == [
+            ['http://x/a', 'http://x/b', 'http://x/c'],
+            ['http://x/g', 'http://x/h'],
+        ]
+        assert ('http://x/a', 'http://x/c') in report.cut_edges
+        assert report.missing_narrower == [('http://x/e', 'http://x/d')]
+        assert report.missing_broader == [('http://x/f', 'http://x/e')]
+        assert sorted(report.orphans) == ['http://x/g', 'http://x/h']
+        assert sorted(report.orphan_roots) == ['http://x/g', 'http://x/h']
+        assert {'http://x/g', 'http://x/h'} <= set(report.unlabeled)
+        assert 'http://x/f' not in report.unlabeled
+
+    def test_repair(self):
+        self.the.validate(repair=True)
+        report = self.the.validate()
+        assert report.is_dag
+        assert set(self.the.broaders(uri('f'))) == \
+            {uri('e'), uri('d'), uri('a'), self.the.top_uri}
+        compiled = self.the.compile()
+        assert (compiled.tree()[1] >= 0).all()
+
+    def test_old_snapshot(self):
+        arrays = self.the.compile().to_arrays()
+        del arrays['narrower_indptr'], arrays['narrower_indices']
+        report = validate_hierarchy(CompiledThesaurus.from_arrays(arrays))
+        assert not report.missing_narrower and not report.missing_broader
+        assert len(report.cycles) == 2
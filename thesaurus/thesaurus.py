@@ -5,16 +5,20 @@ from collections import defaultdict
 from time import time
 import logging
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import rdflib
 from rdflib.namespace import SKOS
-import requests
 import pickle
 import scipy, scipy.sparse
-import pp_api
 from datetime import datetime
 
+from thesaurus.compiled import compile_thesaurus, get_compiled, lookup_sorted, \
+    CompiledThesaurus
+from thesaurus.diff import diff_compiled
+from thesaurus.sim_dict import save_sim_dict
+from thesaurus.validation import validate_hierarchy, repair_hierarchy
+
 
-logging.basicConfig(format='%(name)s at %(asctime)s: %(message)s')
 log_level_str = os.environ.get('LOG_LEVEL', logging.WARNING)
 log_level = getattr(logging, str(log_level_str), logging.WARNING)
 logger = logging.getLogger(__name__)
@@ -176,25 +180,84 @@ class Thesaurus(rdflib.graph.Graph):
                  rdflib.Literal(old_freq+cpt_freq))
             )
 
-    def query_and_add_cpt_frequencies(self, sparql_endpoint, cpt_freq_graph,
-                                      server=None, pid=None, auth_data=None):
-        self.query_thesaurus(pid=pid, server=server, auth_data=auth_data)
-        cpt_freqs = query_cpt_freqs(sparql_endpoint, cpt_freq_graph)
+    def add_cpt_frequencies(self, cpt_freqs):
+        """
+        :param cpt_freqs: {cpt_uri: {'frequency': cpt_freq, ...}} as returned
+            by `query_cpt_freqs`
+        """
         for cpt_uri in cpt_freqs:
             cpt_atts = cpt_freqs[cpt_uri]
             cpt_freq = cpt_atts['frequency']
             if cpt_freq > 0:
                 self.add_frequencies(cpt_uri, cpt_freq)
 
+    def add_frequencies_bulk(self, cpt_freq_batches, compiled=None):
+        """
+        Same as calling `add_frequencies` for every concept, but the
+        frequencies are propagated to the broader concepts with one sparse
+        product over the compiled hierarchy. Concepts that are not part of
+        the thesaurus are skipped.
+
+        :param cpt_freq_batches: iterable of (cpt_uris, freqs) batches, e.g.
+            from `iter_cpt_freqs`
+        :param compiled: CompiledThesaurus of self, compiled if not given
+        """
+        if compiled is None:
+            compiled = self.compile()
+        own_inc = np.zeros(len(compiled))
+        n_skipped = 0
+        for batch in cpt_freq_batches:
+            cpt_uris, freqs = batch[:2]
+            freqs = np.asarray(freqs, dtype=np.float64)
+            inds, found = lookup_sorted(compiled.cpt_uris, cpt_uris)
+            n_skipped += (~found).sum()
+            keep = found & (freqs > 0)
+            np.add.at(own_inc, inds[keep], freqs[keep])
+        if n_skipped:
+            logger.warning('{} concepts with frequencies are not in the '
+                           'thesaurus'.format(n_skipped))
+        cum_inc = compiled.ancestor_matrix().astype(bool).T @ own_inc
+        for predicate, old, inc in [
+            (self.own_freq_predicate, compiled.get_own_freqs(0), own_inc),
+            (self.cum_freq_predicate, compiled.get_cumulative_freqs(0), cum_inc)
+        ]:
+            for i in np.flatnonzero(inc):
+                self.set((rdflib.URIRef(compiled.cpt_uris[i]),
+                          predicate,
+                          rdflib.Literal(old[i] + inc[i])))
+        self.get_cumulative_freq.cache_clear()
+
+    def query_and_add_cpt_frequencies(self, sparql_endpoint, cpt_freq_graph,
+                                      server=None, pid=None, auth_data=None,
+                                      validate=False, repair=False):
+        # The frequencies are fetched while the export is being downloaded
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            cpt_freqs = executor.submit(query_cpt_freqs,
+                                        sparql_endpoint, cpt_freq_graph)
+            self.query_thesaurus(pid=pid, server=server, auth_data=auth_data)
+            if validate or repair:
+                self.validate(repair=repair)
+            self.add_cpt_frequencies(cpt_freqs.result())
+
     def query_thesaurus(self, pid, server=None, auth_data=None, pp=None):
         assert pp or (server and auth_data)
         if pp is None:
+            import pp_api
             pp = pp_api.PoolParty(
                 server=server,
                 auth_data=auth_data
             )
         r = pp.export_project(pid=pid)
-        self.parse(data=r, format='n3')
+        self.parse_export(data=r)
+
+    def parse_export(self, data=None, source=None, format='n3'):
+        """
+        Parse a project export and hang its top concepts below `self.top_uri`.
+
+        :param data: the export as string or bytes
+        :param source: file-like object to read the export from instead
+        """
+        self.parse(data=data, source=source, format=format)
         top_cpts = {x[0] for x in self.triples((
             None,
             rdflib.namespace.SKOS.topConceptOf,
@@ -369,49 +432,104 @@ class Thesaurus(rdflib.graph.Graph):
                                        **kwargs):
         cpt_freqs = query_cpt_freqs(sparql_endpoint, cpt_freq_graph)
         self.parse(file_name, format=format)
-        for cpt_uri in cpt_freqs:
-            cpt_atts = cpt_freqs[cpt_uri]
-            cpt_freq = cpt_atts['frequency']
-            if cpt_freq > 0:
-                self.add_frequencies(cpt_uri, cpt_freq)
+        self.add_cpt_frequencies(cpt_freqs)
 
     def get_sim_dict(self, sim_dict_path, refresh=False):
         return get_sim_dict(sim_dict_path, self, refresh=refresh)
 
+    def compile(self, lang='en'):
+        """
+        :return: thesaurus.compiled.CompiledThesaurus snapshot of the thesaurus
+        """
+        return compile_thesaurus(self, lang=lang)
+
+    def get_compiled(self, snapshot_path, refresh=False, lang='en',
+                     with_layout=False):
+        return get_compiled(snapshot_path, self, refresh=refresh, lang=lang,
+                            with_layout=with_layout)
+
+    def diff(self, other, lang='en'):
+        """
+        Compare the compiled snapshots of self (the old version) and `other`
+        (the new version), see :func:`thesaurus.diff.diff_compiled`.
+
+        :param other: Thesaurus or CompiledThesaurus
+        :return: thesaurus.diff.ThesaurusDiff
+        """
+        if not isinstance(other, CompiledThesaurus):
+            other = other.compile(lang=lang)
+        return diff_compiled(self.compile(lang=lang), other)
+
+    def validate(self, lang='en', repair=False, compiled=None):
+        """
+        Check the hierarchy for cycles, inconsistent inverse links, orphans
+        and concepts without labels in `lang`, see
+        :func:`thesaurus.validation.validate_hierarchy`.
+
+        :param repair: turn the hierarchy into a DAG below the top concept;
+            a `compiled` snapshot is outdated after a repair
+        :param compiled: CompiledThesaurus of self, compiled if not given
+        :return: thesaurus.validation.HierarchyReport
+        """
+        if compiled is None:
+            compiled = self.compile(lang=lang)
+        report = validate_hierarchy(compiled)
+        if not report.is_dag:
+            logger.warning('Invalid hierarchy: {}'.format(report))
+            if repair:
+                repair_hierarchy(self, report)
+        return report
+
     @classmethod
     def get_the(cls, the_path, auth_data, server, pid,
                 sparql_endpoint=None, cpt_freq_graph=None, with_freqs=True,
-                refresh=False, **kwargs):
+                refresh=False, validate=True, repair=False, **kwargs):
+        """
+        :param validate: check the hierarchy after loading, see `validate`
+        :param repair: repair the hierarchy before the frequencies are
+            propagated; a thesaurus loaded from `the_path` is repaired, but
+            its stored frequencies are kept
+        """
         the = cls()
         if the_path is not None and os.path.exists(the_path) and not refresh:
             logger.info('Thesaurus at {} exists, loading'.format(the_path))
             with open(the_path, 'rb') as f:
                 the.parse(the_path, format='n3')
+            if validate or repair:
+                the.validate(repair=repair)
         elif with_freqs:
             logger.info('Querying thesaurus and frequencies')
             the.query_and_add_cpt_frequencies(
                 auth_data=auth_data, server=server, pid=pid,
-                sparql_endpoint=sparql_endpoint, cpt_freq_graph=cpt_freq_graph
+                sparql_endpoint=sparql_endpoint, cpt_freq_graph=cpt_freq_graph,
+                validate=validate, repair=repair
             )
             the.serialize(the_path, format='n3')
         else:
             logger.info('Querying thesaurus')
             the.query_thesaurus(pid=pid, server=server, auth_data=auth_data)
+            if validate or repair:
+                the.validate(repair=repair)
             logger.info('Precomputing children')
             the.precompute_number_children()
             the.serialize(the_path, format='n3')
         return the
 
     @classmethod
-    def get_the_pp(cls, the_path, pp, pid, refresh=False, **kwargs):
+    def get_the_pp(cls, the_path, pp, pid, refresh=False, validate=True,
+                   repair=False, **kwargs):
         the = cls()
         if the_path is not None and os.path.exists(the_path) and not refresh:
             logger.info('Thesaurus at {} exists, loading'.format(the_path))
             with open(the_path, 'rb') as f:
                 the.parse(the_path, format='n3')
+            if validate or repair:
+                the.validate(repair=repair)
         else:
             logger.info('Querying thesaurus')
             the.query_thesaurus(pp=pp, pid=pid)
+            if validate or repair:
+                the.validate(repair=repair)
             logger.info('Precomputing children')
             the.precompute_number_children()
             if the_path is not None:
@@ -536,22 +654,81 @@ def get_sim_dict(sim_dict_path, the, refresh=False):
         sim_dict = scipy.sparse.coo_matrix(sim_dict)
         all_cpts = [str(x) for x in all_cpts]
         if sim_dict_path is not None:
-            with open(sim_dict_path, 'wb') as f:
-                pickle.dump((sim_dict, all_cpts), f)
+            save_sim_dict(sim_dict_path, sim_dict, all_cpts)
     return sim_dict, all_cpts
 
 
-def query_cpt_freqs(sparql_endpoint, cpt_occur_graph):
-    q_cpts = """
+CPT_FREQS_QUERY = """
     select distinct ?s ?label ?freq ?cpt where {
       ?s <http://schema.semantic-web.at/ppcm/2013/5/frequencyInCorpus> ?freq .
       ?s <http://schema.semantic-web.at/ppcm/2013/5/mainLabel> ?label .
       ?s <http://schema.semantic-web.at/ppcm/2013/5/concept> ?cpt .
     }
     """
+
+
+CPT_FREQS_PAGE_QUERY = """
+    select ?cpt (max(?freq) as ?frequency){label_select} where {{
+      ?s <http://schema.semantic-web.at/ppcm/2013/5/frequencyInCorpus> ?freq .
+      ?s <http://schema.semantic-web.at/ppcm/2013/5/concept> ?cpt .{label_pattern}
+      {keyset_filter}
+    }}
+    group by ?cpt
+    order by str(?cpt)
+    limit {limit}
+    """
+
+
+def iter_cpt_freqs(sparql_endpoint, cpt_occur_graph, page_size=10000,
+                   with_labels=False, query_sparql=None):
+    """
+    Paged version of `query_cpt_freqs`. The pages are fetched with keyset
+    pagination on the concept URI, so every page costs the same.
+
+    :param page_size: number of concepts per page
+    :param with_labels: also fetch the main labels
+    :param query_sparql: function (sparql_endpoint, graph, query) -> rows,
+        `pp_api.query_sparql_endpoint` by default
+    :return: generator of (cpt_uris, freqs) batches, where cpt_uris is a list
+        of strings and freqs an np.ndarray, or (cpt_uris, freqs, labels) if
+        `with_labels`
+    """
+    if query_sparql is None:
+        import pp_api
+        query_sparql = pp_api.query_sparql_endpoint
+    last_uri = None
+    while True:
+        q = CPT_FREQS_PAGE_QUERY.format(
+            label_select=' (sample(?label) as ?mainLabel)' if with_labels
+            else '',
+            label_pattern='\n      ?s <http://schema.semantic-web.at/ppcm/'
+                          '2013/5/mainLabel> ?label .' if with_labels else '',
+            keyset_filter='' if last_uri is None else
+            'filter(str(?cpt) > "{}")'.format(
+                last_uri.replace('\\', '\\\\').replace('"', '\\"')
+            ),
+            limit=page_size
+        )
+        rows = [[str(x) for x in r]
+                for r in query_sparql(sparql_endpoint, cpt_occur_graph, q)]
+        if not rows:
+            break
+        cpt_uris = [r[0] for r in rows]
+        freqs = np.array([float(r[1]) for r in rows])
+        if with_labels:
+            yield cpt_uris, freqs, [r[2] for r in rows]
+        else:
+            yield cpt_uris, freqs
+        if len(rows) < page_size:
+            break
+        last_uri = cpt_uris[-1]
+
+
+def query_cpt_freqs(sparql_endpoint, cpt_occur_graph):
+    import pp_api
     rs = pp_api.query_sparql_endpoint(sparql_endpoint,
                                       cpt_occur_graph,
-                                      q_cpts)
+                                      CPT_FREQS_QUERY)
     results = dict()
     for r in rs:
         cpt_atts = {
@@ -564,6 +741,8 @@ def query_cpt_freqs(sparql_endpoint, cpt_occur_graph):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(name)s at %(asctime)s: %(message)s')
+    import pp_api
     import networkx as nx
     import matplotlib.pyplot as plt
     from pp_api.server_data.custom_apps import pid, server, \
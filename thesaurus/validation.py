@@ -0,0 +1,167 @@
+"""
+Structural validation of the broader/narrower hierarchy.
+
+Exports sometimes contain broader cycles, narrower links without the inverse
+broader link (and vice versa) or concepts that are not attached to the top
+concept. The property paths in `Thesaurus.broaders` and
+`Thesaurus.add_frequencies` and the Lin similarity assume a DAG below `:T`.
+`validate_hierarchy` checks the compiled adjacency in time linear in the
+number of links, `repair_hierarchy` turns the thesaurus into such a DAG.
+"""
+import logging
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+
+logger = logging.getLogger(__name__)
+
+
+class HierarchyReport:
+    """
+    Result of `validate_hierarchy`. All concepts are given by their URIs.
+
+    :ivar cycles: list of lists of concepts that are broader than each other
+        (strongly connected components and concepts broader than themselves)
+    :ivar cut_edges: (concept, broader concept) links that `repair_hierarchy`
+        removes to break the cycles
+    :ivar missing_narrower: (concept, broader concept) links without the
+        inverse narrower link
+    :ivar missing_broader: (concept, broader concept) links only stated as
+        narrower links
+    :ivar orphans: concepts from which the top concept is not reachable
+        after cutting the cycles
+    :ivar orphan_roots: orphans without broader concepts after cutting the
+        cycles, `repair_hierarchy` attaches them to the top concept
+    :ivar unlabeled: concepts without a preferred label in the compiled
+        language
+    """
+
+    def __init__(self, cycles, cut_edges, missing_narrower, missing_broader,
+                 orphans, orphan_roots, unlabeled):
+        self.cycles = cycles
+        self.cut_edges = cut_edges
+        self.missing_narrower = missing_narrower
+        self.missing_broader = missing_broader
+        self.orphans = orphans
+        self.orphan_roots = orphan_roots
+        self.unlabeled = unlabeled
+
+    @property
+    def is_dag(self):
+        """
+        True if the hierarchy is a DAG below the top concept with consistent
+        inverse links, i.e. if there is nothing to repair.
+        """
+        return not (self.cycles or self.missing_narrower or
+                    self.missing_broader or self.orphans)
+
+    def __str__(self):
+        return ('HierarchyReport({} cycles, {} cut links, {} missing '
+                'narrower, {} missing broader, {} orphans, {} unlabeled)'
+                .format(len(self.cycles), len(self.cut_edges),
+                        len(self.missing_narrower), len(self.missing_broader),
+                        len(self.orphans), len(self.unlabeled)))
+
+
+def _edges(matrix, cpt_uris):
+    matrix = matrix.tocoo()
+    return [(cpt_uris[i], cpt_uris[j]) for i, j in zip(matrix.row, matrix.col)]
+
+
+def validate_hierarchy(compiled):
+    """
+    :param compiled: thesaurus.compiled.CompiledThesaurus
+    :return: HierarchyReport
+    """
+    cpt_uris = compiled.cpt_uris.tolist()
+    n = len(compiled)
+    broader = compiled.broader_matrix.astype(bool)
+    # narrower links as (concept, broader concept) pairs
+    stated_broader = compiled.narrower_matrix.T.tocsr().astype(bool)
+    missing_narrower = broader > stated_broader
+    missing_broader = stated_broader > broader
+    hierarchy = (broader + stated_broader).tocsr()
+
+    n_comps, comps = scipy.sparse.csgraph.connected_components(
+        hierarchy, directed=True, connection='strong'
+    )
+    comp_sizes = np.bincount(comps, minlength=n_comps)
+    edges = hierarchy.tocoo()
+    in_cycle = (comps[edges.row] == comps[edges.col]) & \
+        ((comp_sizes[comps[edges.row]] > 1) | (edges.row == edges.col))
+    cyclic_comps = np.unique(comps[edges.row[in_cycle]])
+    cycles = [[cpt_uris[i] for i in np.flatnonzero(comps == c)]
+              for c in cyclic_comps]
+
+    # Inside a cycle only keep the links that go up towards the top concept,
+    # the shortest paths from the top concept are left intact
+    depth = scipy.sparse.csgraph.shortest_path(
+        hierarchy.T.tocsr(), indices=compiled.top_ind, unweighted=True
+    )
+    cut = in_cycle & ~(depth[edges.col] < depth[edges.row])
+    cut_edges = [(cpt_uris[i], cpt_uris[j])
+                 for i, j in zip(edges.row[cut], edges.col[cut])]
+
+    orphan_mask = ~np.isfinite(depth)
+    orphan_mask[compiled.top_ind] = False
+    kept = ~cut & (edges.row != compiled.top_ind)
+    has_broader = np.zeros(n, dtype=bool)
+    has_broader[edges.row[kept]] = True
+    unlabeled = (compiled.pref_labels == '')
+    unlabeled[compiled.top_ind] = False
+
+    report = HierarchyReport(
+        cycles=cycles,
+        cut_edges=cut_edges,
+        missing_narrower=_edges(missing_narrower, cpt_uris),
+        missing_broader=_edges(missing_broader, cpt_uris),
+        orphans=[cpt_uris[i] for i in np.flatnonzero(orphan_mask)],
+        orphan_roots=[cpt_uris[i]
+                      for i in np.flatnonzero(orphan_mask & ~has_broader)],
+        unlabeled=[cpt_uris[i] for i in np.flatnonzero(unlabeled)],
+    )
+    logger.info(str(report))
+    return report
+
+
+def repair_hierarchy(the, report):
+    """
+    Turn the hierarchy of `the` into a DAG below the top concept: remove the
+    `cut_edges`, add the missing inverse links and attach the orphan roots
+    to the top concept. Labels are not repaired.
+
+    Frequencies that were propagated before the repair are not recomputed.
+
+    :param the: thesaurus.thesaurus.Thesaurus that `report` was computed for
+    :param report: HierarchyReport
+    :return: the
+    """
+    import rdflib
+    from rdflib.namespace import SKOS
+
+    def link(cpt, broader_cpt):
+        cpt, broader_cpt = rdflib.URIRef(cpt), rdflib.URIRef(broader_cpt)
+        return ((cpt, SKOS.broader, broader_cpt),
+                (broader_cpt, SKOS.narrower, cpt))
+
+    for cpt, broader_cpt in report.cut_edges:
+        for triple in link(cpt, broader_cpt):
+            the.remove(triple)
+    cut = set(report.cut_edges)
+    for cpt, broader_cpt in report.missing_narrower + report.missing_broader:
+        if (cpt, broader_cpt) not in cut:
+            for triple in link(cpt, broader_cpt):
+                the.add(triple)
+    for cpt in report.orphan_roots:
+        for triple in link(cpt, str(the.top_uri)):
+            the.add(triple)
+    the.broaders.cache_clear()
+    the.get_cumulative_freq.cache_clear()
+    logger.info('Repaired hierarchy: removed {} links, added {} inverse '
+                'links, attached {} concepts to {}'.format(
+                    len(report.cut_edges),
+                    len(report.missing_narrower) + len(report.missing_broader),
+                    len(report.orphan_roots), the.top_uri))
+    return the